@@ -8,51 +8,440 @@ import logging
 import os
 import datetime
 import tempfile
+import hashlib
+import shutil
+import threading
+import time
+import zlib
 from waitress import serve
-from flask import Flask, request, make_response
-from redis import Redis
-from rq import Queue  # type: ignore
+from flask import Flask, Response, request, make_response, jsonify
+from redis import Redis, WatchError
+from rq.job import Job, JobStatus  # type: ignore
+from rq.exceptions import NoSuchJobError  # type: ignore
 from werkzeug.utils import secure_filename
-from gtfs2geojson import convert_sync
+from gtfs2geojson import convert_sync, GEOJSON_CONVERTER
+from disk_cache import DiskCache, make_key
+import utils
+import queues
+import metrics
 
 import init_log
 
 
 init_log.config_api_log()
 
-q = Queue(connection=Redis.from_url(os.environ.get("REDIS_URL") or "redis://"))
+redis = Redis.from_url(os.environ.get("REDIS_URL") or "redis://")
 
 app = Flask(__name__)
 
+SYNC_CACHE_DIR = os.environ.get(
+    "SYNC_CACHE_DIR", os.path.join(tempfile.gettempdir(), "geojson_sync_cache")
+)
+SYNC_CACHE_MAX_SIZE = int(os.environ.get("SYNC_CACHE_MAX_SIZE", 2 * 1024 ** 3))
+CHUNK_SIZE = 64 * 1024
 
-def _convert(conversion_type):
-    datagouv_id = request.args.get("datagouv_id")
-    url = request.args.get("url")
-    if datagouv_id and url:
-        q.enqueue(
-            "jobs.convert",
+# number of synchronous conversions running at the same time,
+# and number of requests allowed to wait (at most SYNC_CONVERSION_QUEUE_TIMEOUT seconds) for one
+SYNC_CONVERSION_SLOTS = int(os.environ.get("SYNC_CONVERSION_SLOTS", 2))
+SYNC_CONVERSION_QUEUE_SIZE = int(os.environ.get("SYNC_CONVERSION_QUEUE_SIZE", 4))
+SYNC_CONVERSION_QUEUE_TIMEOUT = float(
+    os.environ.get("SYNC_CONVERSION_QUEUE_TIMEOUT", 10)
+)
+# delay (in seconds) advised to the rejected clients
+SYNC_CONVERSION_RETRY_AFTER = int(os.environ.get("SYNC_CONVERSION_RETRY_AFTER", 30))
+# number of threads of the http server
+API_THREADS = int(os.environ.get("API_THREADS", 8))
+# maximum number of conversions in a batch request
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 2000))
+CONVERSION_TYPES = ["gtfs2geojson", "gtfs2netex"]
+# number of tries of the enqueuing transaction, when the jobs are modified at the same time,
+# and delay (in seconds) advised to the clients when they all fail
+ENQUEUE_ATTEMPTS = int(os.environ.get("ENQUEUE_ATTEMPTS", 5))
+ENQUEUE_RETRY_AFTER = int(os.environ.get("ENQUEUE_RETRY_AFTER", 5))
+
+sync_cache = DiskCache(SYNC_CACHE_DIR, SYNC_CACHE_MAX_SIZE)
+
+
+class _ConversionSlots:
+    """
+    Bounds the number of conversions running at the same time.
+
+    A few requests can wait for a free slot, the others are rejected right away.
+    """
+
+    def __init__(self, nb_slots, queue_size, timeout):
+        self._semaphore = threading.BoundedSemaphore(nb_slots)
+        self._lock = threading.Lock()
+        self._nb_waiting = 0
+        self._queue_size = queue_size
+        self._timeout = timeout
+
+    def acquire(self):
+        """
+        Takes a slot, and returns the time waited for it, or None if no slot is available
+        """
+        start = time.monotonic()
+        if self._semaphore.acquire(blocking=False):
+            return 0.0
+        with self._lock:
+            if self._nb_waiting >= self._queue_size:
+                return None
+            self._nb_waiting += 1
+        try:
+            if not self._semaphore.acquire(timeout=self._timeout):
+                return None
+        finally:
+            with self._lock:
+                self._nb_waiting -= 1
+        return time.monotonic() - start
+
+    def release(self):
+        self._semaphore.release()
+
+
+conversion_slots = _ConversionSlots(
+    SYNC_CONVERSION_SLOTS, SYNC_CONVERSION_QUEUE_SIZE, SYNC_CONVERSION_QUEUE_TIMEOUT
+)
+
+
+def _job_id(url, datagouv_id, conversion_type=None):
+    """
+    The job id is deterministic, so we can find the job converting the same GTFS
+    """
+    key = f"{url}\n{datagouv_id}"
+    if conversion_type:
+        key += "\n" + ",".join(sorted(conversion_type))
+    return f"convert-{hashlib.sha1(key.encode()).hexdigest()}"
+
+
+def _fetch_job(job_id):
+    try:
+        return Job.fetch(job_id, connection=redis)
+    except NoSuchJobError:
+        return None
+
+
+def _fetch_jobs(job_ids):
+    """
+    Returns the jobs (None if the job does not exist) and their status,
+    all read in one round trip
+    """
+    with redis.pipeline(transaction=False) as read_pipe:
+        for job_id in job_ids:
+            read_pipe.hgetall(Job.key_for(job_id))
+        job_hashes = read_pipe.execute()
+
+    jobs = []
+    for job_id, job_hash in zip(job_ids, job_hashes):
+        if not job_hash:
+            jobs.append((None, None))
+            continue
+        job = Job(job_id, connection=redis)
+        job.restore(job_hash)
+        jobs.append((job, job_hash.get(b"status", b"").decode() or None))
+    return jobs
+
+
+def _plan_conversion(
+    job_id, job, status, url, datagouv_id, conversion_type, queue_name
+):
+    """
+    Plans the conversion with the job `job_id` (`job` is None if it does not exist).
+
+    If the same conversion is already waiting in the queue, we merge the conversion types
+    in this job instead of enqueuing a new one.
+    If the job is already running, the missing conversions are done in a follow-up job.
+    Otherwise a new job is enqueued in the `queue_name` queue.
+
+    Returns the function adding the needed commands to the transaction
+    (None if there is nothing to do), and the conversions missing in the running job
+    """
+    if status in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED):
+        params = job.args[0]
+        missing = [c for c in conversion_type if c not in params["conversion_type"]]
+        if not missing:
+            return None, None
+        params["conversion_type"] = params["conversion_type"] + missing
+        job.args = (params,)
+        return job.save, None
+
+    if status == JobStatus.STARTED:
+        missing = [
+            c for c in conversion_type if c not in job.args[0]["conversion_type"]
+        ]
+        return None, missing or None
+
+    queue = queues.get_queue(queue_name, connection=redis)
+    new_job = queue.create_job(
+        "jobs.convert",
+        args=(
             {
                 "url": url,
                 "datagouv_id": datagouv_id,
                 "task_date": datetime.datetime.today(),
                 "conversion_type": conversion_type,
             },
-            job_timeout="30m",
-            result_ttl=86400,
-        )
+        ),
+        job_id=job_id,
+        timeout="30m",
+        result_ttl=86400,
+    )
+
+    def enqueue(pipeline):
+        if job:
+            # there is an old finished (or failed) job with the same id.
+            # It is not in the queue, and removing it from the queue would execute
+            # the pipeline (with rq 1.4) before the end of the transaction
+            job.delete(pipeline=pipeline, remove_from_queue=False)
+        queue.enqueue_job(new_job, pipeline=pipeline)
+
+    return enqueue, None
+
+
+def _plan_conversions(pipe, feeds, queue_names):
+    """
+    Watches the jobs that can do the conversions of the feeds, and plans the conversions.
+
+    The jobs are read in one round trip, and once more for the follow-ups
+    of the running jobs.
+
+    Returns by feed the id of the job doing the conversion, and the function adding
+    the needed commands to the transaction (None if there is nothing to do)
+    """
+    plans = {}
+    candidates = {
+        feed: (_job_id(*feed), conversion_type)
+        for feed, conversion_type in feeds.items()
+    }
+    while candidates:
+        job_ids = [job_id for job_id, _ in candidates.values()]
+        pipe.watch(*[Job.key_for(job_id) for job_id in job_ids])
+        follow_ups = {}
+        for (feed, (job_id, conversion_type)), (job, status) in zip(
+            candidates.items(), _fetch_jobs(job_ids)
+        ):
+            add_commands, missing = _plan_conversion(
+                job_id, job, status, *feed, conversion_type, queue_names[feed[0]]
+            )
+            if missing:
+                follow_ups[feed] = (_job_id(*feed, missing), missing)
+            else:
+                plans[feed] = (job_id, add_commands)
+        candidates = follow_ups
+    return plans
+
+
+def _enqueue_conversions(conversions, probe_sizes=True):
+    """
+    Enqueues the conversions, given as (url, datagouv_id, conversion_type), in one transaction.
+
+    The conversions of the same feed are merged.
+    The feeds never seen by a worker are routed with a HEAD request if `probe_sizes` is True,
+    else they go in the large queue.
+
+    Returns the ids of the jobs doing the conversions.
+    Raises a WatchError if the jobs keep being modified during the transaction
+    """
+    feeds = {}
+    for url, datagouv_id, conversion_type in conversions:
+        types = feeds.setdefault((url, datagouv_id), [])
+        types += [c for c in conversion_type if c not in types]
+
+    # the size of the feeds is needed before the transaction, it can need http requests
+    queue_names = queues.conversion_queue_names(
+        [url for url, _ in feeds], connection=redis, probe=probe_sizes
+    )
+    with redis.pipeline() as pipe:
+        for attempt in range(ENQUEUE_ATTEMPTS):
+            try:
+                plans = _plan_conversions(pipe, feeds, queue_names)
+                pipe.multi()
+                for _, add_commands in plans.values():
+                    if add_commands:
+                        add_commands(pipeline=pipe)
+                pipe.execute()
+                break
+            except WatchError:
+                # a job has been modified in the meantime, we try again
+                logging.info(f"jobs modified during the transaction #{attempt}")
+                if attempt == ENQUEUE_ATTEMPTS - 1:
+                    raise
+    return [plans[(url, datagouv_id)][0] for url, datagouv_id, _ in conversions]
+
+
+def _enqueue_conversion(url, datagouv_id, conversion_type):
+    return _enqueue_conversions([(url, datagouv_id, conversion_type)])[0]
+
+
+def _too_many_modifications():
+    return Response(
+        "the jobs are being modified, retry later",
+        status=503,
+        headers={"Retry-After": str(ENQUEUE_RETRY_AFTER)},
+    )
+
+
+def _convert(conversion_type):
+    datagouv_id = request.args.get("datagouv_id")
+    url = request.args.get("url")
+    if datagouv_id and url:
+        try:
+            job_id = _enqueue_conversion(url, datagouv_id, conversion_type)
+        except WatchError:
+            return _too_many_modifications()
         logging.info(
-            f"Enquing {url} for datagouv_id {datagouv_id}, for {conversion_type} conversion(s)"
+            f"Enquing {url} for datagouv_id {datagouv_id}, for {conversion_type} conversion(s) in job {job_id}"
         )
-        return "The request was put in a queue"
+        return f"The request was put in a queue, job id: {job_id}"
     else:
         return make_response("url and datagouv_id parameters are required", 400)
 
 
+def _parse_batch(batch):
+    """
+    Returns the conversions of the batch as (url, datagouv_id, conversion_type),
+    raises a ValueError if the batch is not valid
+    """
+    if not isinstance(batch, list):
+        raise ValueError("a list of conversions is required")
+    if len(batch) > BATCH_MAX_SIZE:
+        raise ValueError(f"at most {BATCH_MAX_SIZE} conversions can be sent at once")
+    conversions = []
+    for i, item in enumerate(batch):
+        if (
+            not isinstance(item, dict)
+            or not isinstance(item.get("url"), str)
+            or not isinstance(item.get("datagouv_id"), str)
+            or not item["url"]
+            or not item["datagouv_id"]
+        ):
+            raise ValueError(f"item {i}: url and datagouv_id are required")
+        conversion_type = item.get("conversion_type", CONVERSION_TYPES)
+        if (
+            not isinstance(conversion_type, list)
+            or not conversion_type
+            or any(c not in CONVERSION_TYPES for c in conversion_type)
+        ):
+            raise ValueError(
+                f"item {i}: conversion_type should be a list of {CONVERSION_TYPES}"
+            )
+        conversions.append((item["url"], item["datagouv_id"], conversion_type))
+    return conversions
+
+
+def _convert_batch():
+    try:
+        conversions = _parse_batch(request.get_json(force=True, silent=True))
+    except ValueError as e:
+        return make_response(str(e), 400)
+
+    try:
+        # probing thousands of feeds would take tens of minutes, the unknown feeds
+        # go in the large queue, and the workers will record their size for the next batches
+        job_ids = _enqueue_conversions(conversions, probe_sizes=False)
+    except WatchError:
+        return _too_many_modifications()
+    logging.info(f"Enquing a batch of {len(conversions)} conversions")
+    return jsonify(
+        [
+            {"url": url, "datagouv_id": datagouv_id, "job_id": job_id}
+            for (url, datagouv_id, _), job_id in zip(conversions, job_ids)
+        ]
+    )
+
+
+def _isoformat(date):
+    return date.isoformat() if date else None
+
+
+def _job_description(job):
+    """
+    Returns the status of the job, and the time spent in each stage of its conversions
+    """
+    stages = {}
+    for span in job.meta.get("spans", []):
+        name = ".".join(filter(None, [span["conversion"], span["stage"]]))
+        stages[name] = stages.get(name, 0) + span["duration"]
+
+    params = job.args[0] if job.args and isinstance(job.args[0], dict) else {}
+    return {
+        "id": job.id,
+        "status": job.get_status(),
+        "queue": job.origin,
+        "url": params.get("url"),
+        "datagouv_id": params.get("datagouv_id"),
+        "conversion_type": params.get("conversion_type"),
+        "enqueued_at": _isoformat(job.enqueued_at),
+        "started_at": _isoformat(job.started_at),
+        "ended_at": _isoformat(job.ended_at),
+        "stages": stages,
+        "spans": job.meta.get("spans", []),
+        "failures": job.meta.get("failures", {}),
+        "publish": job.meta.get("publish", {}),
+        "commands": job.meta.get("commands", []),
+    }
+
+
 def _allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ["zip"]
 
 
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _save_upload(file, file_path):
+    """
+    Saves the uploaded file, and returns its sha256
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "wb") as f:
+        for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            f.write(chunk)
+    return sha256.hexdigest()
+
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def _tee_to_cache(chunks, key):
+    """
+    Yields the chunks, and stores them in the cache once they have all been read
+    """
+    with sync_cache.tmp_file() as tmp:
+        try:
+            for chunk in chunks:
+                tmp.write(chunk)
+                yield chunk
+        except BaseException:
+            # the conversion failed (or the client has gone), the result is not complete
+            os.remove(tmp.name)
+            raise
+    sync_cache.put(key, tmp.name)
+
+
+def _stream_geojson(first_chunk, chunks):
+    yield first_chunk
+    try:
+        yield from chunks
+    except Exception:
+        # the response has already started, we can only abort it
+        # (the server closes the connection without ending the response)
+        logging.exception("error in geojson conversion")
+        raise
+
+
 def _convert_to_geojson_sync():
+    tmpdirname = tempfile.mkdtemp()
+    cleanups = [lambda: shutil.rmtree(tmpdirname)]
     try:
         if "file" not in request.files:
             return "no file"
@@ -61,12 +450,61 @@ def _convert_to_geojson_sync():
             return "no filename"
         if file and _allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                file_path = os.path.join(tmpdirname, filename)
-                file.save(file_path)
-                return convert_sync(file_path)
+            file_path = os.path.join(tmpdirname, filename)
+            checksum = _save_upload(file, file_path)
+
+            # the result only depends on the file and on the converter
+            key = make_key(
+                "geojson_sync", checksum, utils.converter_version(GEOJSON_CONVERTER)
+            )
+            use_gzip = (
+                request.accept_encodings.best_match(["gzip", "identity"]) == "gzip"
+            )
+            # the compressed and the uncompressed responses are not the same bytes
+            etag = f"{key}-gzip" if use_gzip else key
+            headers = {"Vary": "Accept-Encoding", "ETag": f'"{etag}"'}
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers=headers)
+
+            cached = sync_cache.get(key)
+            if cached:
+                logging.info("geojson conversion already done, using the cache")
+                chunks = _read_file(cached)
+            else:
+                wait_time = conversion_slots.acquire()
+                if wait_time is None:
+                    logging.warning("too many geojson conversions, request rejected")
+                    return Response(
+                        "too many conversions in progress, retry later",
+                        status=503,
+                        headers={"Retry-After": str(SYNC_CONVERSION_RETRY_AFTER)},
+                    )
+                cleanups.append(conversion_slots.release)
+                logging.info(f"waited {wait_time:.3f}s for a geojson conversion slot")
+                headers["Server-Timing"] = f"queue;dur={wait_time * 1000:.0f}"
+
+                chunks = _tee_to_cache(convert_sync(file_path), key)
+                # we wait for the first chunk, to be able to answer an error
+                # if the conversion fails right away
+                first_chunk = next(chunks, b"")
+                chunks = _stream_geojson(first_chunk, chunks)
+
+            if use_gzip:
+                chunks = _gzip(chunks)
+                headers["Content-Encoding"] = "gzip"
+            response = Response(chunks, mimetype="application/json", headers=headers)
+            # the uploaded file is removed (and the conversion slot released)
+            # only once the response has been sent
+            for cleanup in cleanups:
+                response.call_on_close(cleanup)
+            cleanups = []
+            return response
     except:
+        logging.exception("error in geojson conversion")
         return "error in geojson conversion", 500
+    finally:
+        for cleanup in cleanups:
+            cleanup()
 
 
 @app.route("/gtfs2netexfr")
@@ -89,9 +527,28 @@ def convert_gtfs_to_netex_and_geojson():
     return _convert(["gtfs2geojson", "gtfs2netex"])
 
 
+@app.route("/convert_batch", methods=["POST"])
+def convert_batch():
+    return _convert_batch()
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    job = _fetch_job(job_id)
+    if job is None:
+        return make_response(f"no job {job_id}", 404)
+    return jsonify(_job_description(job))
+
+
+@app.route("/metrics")
+def get_metrics():
+    content, content_type = metrics.latest()
+    return Response(content, content_type=content_type)
+
+
 @app.route("/")
 def index():
     return "Hello, have a look at /gtfs2netexfr or /gtfs2geojson. Nothing else here."
 
 
-serve(app, listen="*:8080")
+serve(app, listen="*:8080", threads=API_THREADS)
@@ -0,0 +1,83 @@
+import os
+import zlib
+import shutil
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# number of files compressed at the same time (zlib releases the GIL, threads are enough)
+ARCHIVE_WORKERS = int(os.environ.get("ARCHIVE_WORKERS", os.cpu_count() or 1))
+CHUNK_SIZE = 1024 * 1024
+# all the members have the same date, so the same files always give the same archive
+MEMBERS_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _compress(path, compression_level, tmp_dir):
+    """
+    Compresses the file with raw deflate (as stored in a zip archive) in a temporary file
+
+    Returns the crc, the size of the file, the path and the size of the compressed file
+    """
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    with open(path, "rb") as src, tempfile.NamedTemporaryFile(
+        dir=tmp_dir, delete=False
+    ) as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+    return crc, size, dst.name, os.path.getsize(dst.name)
+
+
+def _write_compressed_member(zip_file, zinfo, compressed_path):
+    """
+    Writes an already compressed member in the archive.
+
+    zipfile has no public api for this, so we do what `ZipFile.write` does
+    """
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file._didModify = True
+    zip_file.fp.write(zinfo.FileHeader())
+    with open(compressed_path, "rb") as f:
+        shutil.copyfileobj(f, zip_file.fp, CHUNK_SIZE)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
+
+
+def make_zip(archive_path, directory, compression_level):
+    """
+    Creates a zip archive with all the files of the directory.
+
+    The files are compressed in parallel, and written in the archive
+    sorted by name, so the archive is deterministic.
+    """
+    files = sorted(
+        os.path.relpath(os.path.join(root, f), directory)
+        for root, _, dir_files in os.walk(directory)
+        for f in dir_files
+    )
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(archive_path))
+    ) as tmp_dir, ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+        compressions = [
+            executor.submit(
+                _compress, os.path.join(directory, f), compression_level, tmp_dir
+            )
+            for f in files
+        ]
+        with zipfile.ZipFile(archive_path, "w") as zip_file:
+            for name, compression in zip(files, compressions):
+                crc, size, compressed_path, compressed_size = compression.result()
+
+                zinfo = zipfile.ZipInfo(name, date_time=MEMBERS_DATE_TIME)
+                zinfo.external_attr = 0o644 << 16
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.CRC = crc
+                zinfo.file_size = size
+                zinfo.compress_size = compressed_size
+                _write_compressed_member(zip_file, zinfo, compressed_path)
+                os.remove(compressed_path)
@@ -0,0 +1,88 @@
+"""
+Snapshot of the transport.data.gouv.fr catalog (the /api/datasets route).
+
+The catalog is kept on disk, revalidated with conditional requests,
+and parsed only once (as long as it does not change): the catalog with its indexes
+is kept on disk too, for the next processes (rq runs each task in a new process).
+"""
+import os
+import json
+import pickle
+import logging
+import tempfile
+import collections
+import utils
+from disk_cache import DiskCache, make_key
+
+TRANSPORT_API_ENDPOINT = "https://transport.data.gouv.fr"
+CATALOG_CACHE_DIR = os.environ.get(
+    "CATALOG_CACHE_DIR", os.path.join(tempfile.gettempdir(), "catalog_cache")
+)
+# the catalog is not revalidated if it has been fetched less than CATALOG_MAX_AGE seconds ago
+CATALOG_MAX_AGE = int(os.environ.get("CATALOG_MAX_AGE", 600))
+PAN_PUBLISHER = "Point d'Accès National transport.data.gouv.fr"
+# to be changed when the Catalog class changes, so the stored catalogs are not used
+_CATALOG_FORMAT = "1"
+
+_cache = None
+_catalog = None
+
+
+class Catalog:
+    """
+    The datasets of transport.data.gouv.fr, with some indexes
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.public_transit_datasets = {
+            d["id"]: d for d in datasets if d["type"] == "public-transit"
+        }
+        self._community_resources = collections.defaultdict(list)
+        for d in self.public_transit_datasets.values():
+            for r in d.get("community_resources", []):
+                key = (r.get("community_resource_publisher"), r.get("format"))
+                self._community_resources[key].append((d, r))
+
+    def community_resources(self, publisher, resource_format):
+        """
+        Returns the community resources of the public transit datasets
+        with this publisher and this format, as (dataset, community resource) tuples
+        """
+        return self._community_resources[(publisher, resource_format)]
+
+
+def get_catalog():
+    global _cache, _catalog
+    if _cache is None:
+        # the catalog is only a few MB, we only need to keep its last version
+        _cache = DiskCache(CATALOG_CACHE_DIR, max_size=0, grace_period=CATALOG_MAX_AGE)
+
+    path, _, checksum = utils.download_with_cache(
+        f"{TRANSPORT_API_ENDPOINT}/api/datasets", _cache, max_age=CATALOG_MAX_AGE
+    )
+    if _catalog is None or _catalog[0] != checksum:
+        _catalog = (checksum, _load_catalog(path, checksum))
+    return _catalog[1]
+
+
+def _load_catalog(path, checksum):
+    """
+    Returns the catalog stored with its indexes, or parses it and stores it
+    """
+    key = make_key("catalog", _CATALOG_FORMAT, checksum)
+    stored = _cache.get(key)
+    if stored:
+        try:
+            with open(stored, "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, AttributeError, pickle.UnpicklingError) as e:
+            logging.warning(f"impossible to read the stored catalog: {e}")
+
+    logging.debug("parsing the catalog")
+    with open(path) as f:
+        catalog = Catalog(json.load(f))
+    with _cache.tmp_file() as tmp:
+        pickle.dump(catalog, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+    _cache.put(key, tmp.name)
+    return catalog
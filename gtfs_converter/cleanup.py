@@ -1,29 +1,32 @@
-import requests
 import logging
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datagouv
+import community_resources_index
+import catalog
 from pylogctx import context as log_context
 
-TRANSPORT_API_ENDPOINT = "https://transport.data.gouv.fr"
+# number of deletions done at the same time
+CLEANUP_CONCURRENCY = int(os.environ.get("CLEANUP_CONCURRENCY", 4))
 
 
-def _cleanup_old_dataset_resources(dataset):
+def _plan_dataset_cleanup(dataset):
     """
     for a dataset, we check that all community resource's original resource is still there.
-    If not, we delete the deprecated community resource.
+    If not, the deprecated community resource needs to be deleted.
+
+    Returns the deletions to do
     """
     dataset_id = dataset["datagouv_id"]
     resources_url = {
         r["original_url"]: r["datagouv_id"] for r in dataset.get("resources", [])
     }
 
-    nb_cleaned = 0
+    deletions = []
 
     for cr in dataset.get("community_resources", []):
-        if (
-            cr.get("community_resource_publisher")
-            != "Point d'Accès National transport.data.gouv.fr"
-        ):
+        if cr.get("community_resource_publisher") != catalog.PAN_PUBLISHER:
             # we want to cleanup only community resources created by the PAN
             continue
 
@@ -37,34 +40,66 @@ def _cleanup_old_dataset_resources(dataset):
         logging.info(
             f'for dataset {dataset_id}, resource {cr["title"]} | {cr["url"]} | original_url = {original_resource_url} is deprecated and will be deleted'
         )
+        deletions.append(
+            {
+                "dataset_id": dataset_id,
+                "resource_id": cr["datagouv_id"],
+                "title": cr["title"],
+                "url": cr["url"],
+                "original_url": original_resource_url,
+            }
+        )
+    return deletions
+
 
-        datagouv.delete_community_resources(dataset_id, cr["datagouv_id"])
+def _delete_community_resource(deletion):
+    with log_context(task_id="cleanup"):
+        datagouv.delete_community_resources(
+            deletion["dataset_id"], deletion["resource_id"]
+        )
+        community_resources_index.remove(
+            deletion["dataset_id"], deletion["resource_id"]
+        )
         logging.info(
             "deleted community resource %s (#%s) for the dataset %s",
-            cr["url"],
-            cr["datagouv_id"],
-            dataset_id,
+            deletion["url"],
+            deletion["resource_id"],
+            deletion["dataset_id"],
         )
-        nb_cleaned += 1
-    return nb_cleaned
 
 
-def cleanup_old_resources():
+def cleanup_old_resources(dry_run=False):
     """
     Delete the community resources when the main resource has been deleted
+
+    All the deletions are planned first, and then done in parallel.
+    With `dry_run`, the plan is only logged as json.
+
+    Returns the plan
     """
     with log_context(task_id="cleanup"):
         logging.info("Cleaning up old resources")
-        r = requests.get(f"{TRANSPORT_API_ENDPOINT}/api/datasets")
-        r.raise_for_status()
-        datasets = r.json()
+        plan = []
+        for d in catalog.get_catalog().public_transit_datasets.values():
+            plan += _plan_dataset_cleanup(d)
+        logging.info(f"{len(plan)} resources to clean")
 
-        total_cleaned = 0
+        if dry_run:
+            logging.info(json.dumps(plan, ensure_ascii=False, indent=2))
+            return plan
 
-        for d in datasets:
-            dataset_name = d["title"]
-            if d["type"] != "public-transit":
-                continue
-            cleaned = _cleanup_old_dataset_resources(d)
-            total_cleaned += cleaned
+        total_cleaned = 0
+        with ThreadPoolExecutor(max_workers=CLEANUP_CONCURRENCY) as executor:
+            futures = [executor.submit(_delete_community_resource, d) for d in plan]
+            for nb_done, future in enumerate(as_completed(futures), 1):
+                if future.exception() is None:
+                    total_cleaned += 1
+                else:
+                    logging.error(
+                        "impossible to delete a community resource",
+                        exc_info=future.exception(),
+                    )
+                if nb_done % 50 == 0:
+                    logging.info(f"{nb_done}/{len(plan)} deletions done")
         logging.info(f"{total_cleaned} resources cleaned")
+        return plan
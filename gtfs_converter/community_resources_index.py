@@ -0,0 +1,85 @@
+"""
+Index of the community resources published by transport.data.gouv.fr.
+
+For each dataset, a redis hash maps the original resource url and the format
+of a community resource to its id and its checksum.
+The hash is built with a crawl of all the community resources of the dataset,
+and then kept up to date when we create or delete a community resource.
+"""
+import os
+import json
+import logging
+import datagouv
+from redis_connection import get_redis
+
+# the index of a dataset is crawled again after this delay (in seconds)
+INDEX_TTL = int(os.environ.get("COMMUNITY_RESOURCES_INDEX_TTL", 24 * 3600))
+_CRAWLED = "__crawled__"
+
+
+def _key(dataset_id):
+    return f"community_resources_index:{dataset_id}"
+
+
+def _field(original_url, resource_format):
+    # datagouv lower case the format, we should do the same
+    return f"{resource_format.lower()}|{original_url}"
+
+
+def _crawl(dataset_id):
+    resources = datagouv.get_transport_community_resources(dataset_id)
+    index = {_CRAWLED: "1"}
+    for r in resources:
+        original_url = r.get("extras", {}).get(datagouv.ORIGINAL_URL_KEY)
+        if not original_url or not r.get("format"):
+            continue
+        field = _field(original_url, r["format"])
+        if field in index:
+            logging.warning(
+                "More that one community resource for %s in dataset %s",
+                field,
+                dataset_id,
+            )
+            continue
+        index[field] = json.dumps({"id": r["id"], "checksum": r.get("checksum")})
+    logging.debug("community resources of dataset %s: %s", dataset_id, index)
+
+    with get_redis().pipeline() as pipe:
+        pipe.delete(_key(dataset_id))
+        pipe.hset(_key(dataset_id), mapping=index)
+        pipe.expire(_key(dataset_id), INDEX_TTL)
+        pipe.execute()
+
+
+def get(dataset_id, original_url, resource_format):
+    """
+    Returns the community resource, as a dict with its `id` and its `checksum`
+    (like the data.gouv checksum, a dict with its `type` and its `value`),
+    or None if there is none
+    """
+    key = _key(dataset_id)
+    field = _field(original_url, resource_format)
+    resource, crawled = get_redis().hmget(key, field, _CRAWLED)
+    if crawled is None:
+        _crawl(dataset_id)
+        resource = get_redis().hget(key, field)
+    return json.loads(resource) if resource else None
+
+
+def add(dataset_id, original_url, resource_format, resource_id, checksum):
+    get_redis().hset(
+        _key(dataset_id),
+        _field(original_url, resource_format),
+        json.dumps({"id": resource_id, "checksum": checksum}),
+    )
+
+
+def remove(dataset_id, resource_id):
+    key = _key(dataset_id)
+    fields = [
+        field
+        for field, value in get_redis().hgetall(key).items()
+        if field.decode() != _CRAWLED and json.loads(value)["id"] == resource_id
+    ]
+    if fields:
+        get_redis().hdel(key, *fields)
@@ -1,6 +1,9 @@
 import os
-import requests
+import time
 import logging
+import http_session
+import metrics
+from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor  # type: ignore
 
 DATAGOUV_API = os.environ["DATAGOUV_API"]
 TRANSPORT_ORGANIZATION_ID = os.environ["TRANSPORT_ORGANIZATION_ID"]
@@ -8,6 +11,69 @@ DATAGOUV_API_KEY = os.environ["DATAGOUV_API_KEY"]
 ORIGINAL_URL_KEY = "transport:original_resource_url"
 
 
+class _UploadProgress:
+    """
+    Logs the progress and the throughput of an upload, every 10%
+    """
+
+    def __init__(self, file_name, size):
+        self.file_name = file_name
+        self.size = size
+        self.start = time.monotonic()
+        self.next_step = 0
+
+    def __call__(self, monitor):
+        progress = 100 * monitor.bytes_read // max(self.size, 1)
+        if progress < self.next_step:
+            return
+        self.next_step = progress - progress % 10 + 10
+        elapsed = time.monotonic() - self.start
+        logging.debug(
+            "uploading %s: %s%% (%.1f MB/s)",
+            self.file_name,
+            progress,
+            monitor.bytes_read / 1024 ** 2 / max(elapsed, 0.001),
+        )
+
+
+def upload_file(url, file_path):
+    """
+    Uploads a file as a multipart request and returns the response.
+
+    The file is streamed from the disk, so the memory used does not depend on its size.
+    """
+    file_name = os.path.basename(file_path)
+    for attempt in range(http_session.HTTP_RETRIES + 1):
+        with open(file_path, "rb") as f:
+            encoder = MultipartEncoder(fields={"file": (file_name, f)})
+            monitor = MultipartEncoderMonitor(
+                encoder, _UploadProgress(file_name, encoder.len)
+            )
+            ret = http_session.get_upload_session().post(
+                url,
+                headers={
+                    "X-API-KEY": DATAGOUV_API_KEY,
+                    "Content-Type": monitor.content_type,
+                },
+                data=monitor,
+            )
+        metrics.UPLOADED_BYTES.inc(encoder.len)
+        # the streamed body cannot be retried by the session, we do it here
+        if ret.status_code not in (429, 503) or attempt == http_session.HTTP_RETRIES:
+            break
+        delay = http_session.backoff_time(attempt)
+        logging.warning(
+            "upload of %s failed with %s, retrying in %.1fs",
+            file_name,
+            ret.status_code,
+            delay,
+        )
+        time.sleep(delay)
+
+    ret.raise_for_status()
+    return ret
+
+
 def delete_community_resources(dataset_id, resources_id):
     """
     delete the community resources
@@ -18,30 +84,52 @@ def delete_community_resources(dataset_id, resources_id):
     logging.info(
         "deleting a community resource %s on dataset %s", resources_id, dataset_id
     )
-    ret = requests.delete(url, params={"dataset": dataset_id}, headers=headers)
+    ret = http_session.get_session().delete(
+        url, params={"dataset": dataset_id}, headers=headers
+    )
     if ret.status_code == 404:
         # it's ok if the resource has already been deleted
         return
     ret.raise_for_status()
 
 
+def community_resource_exists(resource_id):
+    """
+    Checks that the community resource has not been deleted
+    """
+    url = f"{DATAGOUV_API}/datasets/community_resources/{resource_id}/"
+    ret = http_session.get_session().get(url)
+    if ret.status_code == 404:
+        return False
+    ret.raise_for_status()
+    return True
+
+
 def get_dataset_detail(dataset_id):
-    ret = requests.get(f"{DATAGOUV_API}/datasets/{dataset_id}/")
+    ret = http_session.get_session().get(f"{DATAGOUV_API}/datasets/{dataset_id}/")
     ret.raise_for_status()
     return ret.json()
 
 
 def get_transport_community_resources(dataset_id):
     """
-    get all community resources for a dataset
+    get all community resources for a dataset, following the pagination
     """
     url = f"{DATAGOUV_API}/datasets/community_resources/"
-    ret = requests.get(
-        url, params={"dataset": dataset_id, "organization": TRANSPORT_ORGANIZATION_ID}
-    )
-    ret.raise_for_status()
-
-    data = ret.json()["data"]
+    params = {
+        "dataset": dataset_id,
+        "organization": TRANSPORT_ORGANIZATION_ID,
+        "page_size": 100,
+    }
+    data = []
+    while url:
+        ret = http_session.get_session().get(url, params=params)
+        ret.raise_for_status()
+        page = ret.json()
+        data.extend(page["data"])
+        # the next page url already contains the parameters
+        url = page.get("next_page")
+        params = None
 
     return data
 
@@ -53,13 +141,9 @@ def create_community_resource(dataset_id, cr_file):
     This call will not link the resource. It requires and extra call
     """
     logging.debug("Creating a community resource on dataset %s", dataset_id)
-    headers = {"X-API-KEY": DATAGOUV_API_KEY}
-    files = {"file": open(cr_file, "rb")}
     url = f"{DATAGOUV_API}/datasets/{dataset_id}/upload/community/"
 
-    ret = requests.post(url, headers=headers, files=files)
-    ret.raise_for_status()
-    json = ret.json()
+    json = upload_file(url, cr_file).json()
 
     logging.debug(
         "Created a new community resource %s on dataset %s", json["id"], dataset_id
@@ -74,17 +158,14 @@ def update_resource(dataset_id, resource_id, new_file, metadata):
     """
     logging.debug("Updating a resource on dataset %s", dataset_id)
     url = f"{DATAGOUV_API}/datasets/{dataset_id}/resources/{resource_id}/upload/"
-    headers = {"X-API-KEY": DATAGOUV_API_KEY}
-    files = {"file": open(new_file, "rb")}
-    ret = requests.post(url, headers=headers, files=files)
-    ret.raise_for_status()
-    updated_resource_json = ret.json()
+    updated_resource_json = upload_file(url, new_file).json()
 
     # after the upload, we set the resource metadata
     new_resource = {**metadata, "id": resource_id}
     logging.debug("Updating metadata of resource %s", resource_id)
 
     url = f"{DATAGOUV_API}/datasets/{dataset_id}/resources/{resource_id}/"
-    ret = requests.put(url, headers=headers, json=new_resource)
+    headers = {"X-API-KEY": DATAGOUV_API_KEY}
+    ret = http_session.get_session().put(url, headers=headers, json=new_resource)
     ret.raise_for_status()
     logging.debug("Updating of resource %s done", resource_id)
@@ -1,6 +1,10 @@
 import datagouv
+import http_session
+import community_resources_index
+import job_metrics
 
 import tempfile
+import hashlib
 import requests
 import os
 import logging
@@ -18,53 +22,41 @@ def _format_title_as_datagouv(title):
 def find_community_resources(dataset_id, new_file, resource_url, resource_format):
     """
     Checks if the a community resource already exists
+
+    Returns the community resource, with its `id` and its `checksum`
     """
-    data = datagouv.get_transport_community_resources(dataset_id)
-    file_name = os.path.basename(new_file)
-    resource_format = (
-        resource_format.lower()
-    )  # datagouv lower case the format, we should do the same
-
-    if data is not None:
-        # Note: datagouv lowercase the file names, so we do the same
-        filtered = [
-            r
-            for r in data
-            if r.get("extras", {}).get(ORIGINAL_URL_KEY) == resource_url
-            and resource_format == r.get("format")
-        ]
-        logging.debug(
-            "title = %s, url = %s, format = %s",
-            _format_title_as_datagouv(file_name),
-            resource_url,
-            resource_format,
-        )
-        logging.debug(
-            "community resources: %s",
-            [
-                (r["title"], r.get("extras", {}).get(ORIGINAL_URL_KEY), r.get("format"))
-                for r in data
-            ],
-        )
-        if len(filtered) == 0:
-            logging.debug("Found the dataset %s, but no existing ressource", dataset_id)
-            return None
-
-        if len(filtered) > 1:
-            logging.warning(
-                "More that one community resource %s in dataset %s",
-                file_name,
-                dataset_id,
-            )
-        logging.debug(
-            "Found dataset %s and matching community resource, with id %s",
-            dataset_id,
-            filtered[0]["id"],
-        )
-        return filtered[0]
-    raise Exception(
-        f"Searched community ressources of dataset {dataset_id}, could not understand response"
+    community_resource = community_resources_index.get(
+        dataset_id, resource_url, resource_format
+    )
+    logging.debug(
+        "title = %s, url = %s, format = %s",
+        _format_title_as_datagouv(os.path.basename(new_file)),
+        resource_url,
+        resource_format,
+    )
+    if community_resource is None:
+        logging.debug("Found the dataset %s, but no existing ressource", dataset_id)
+        return None
+
+    logging.debug(
+        "Found dataset %s and matching community resource, with id %s",
+        dataset_id,
+        community_resource["id"],
     )
+    return community_resource
+
+
+def _has_checksum(file_path, checksum):
+    """
+    Checks if the file has the checksum computed by data.gouv
+    """
+    if not checksum or checksum.get("type") not in hashlib.algorithms_available:
+        return False
+    file_hash = hashlib.new(checksum["type"])
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest() == checksum.get("value")
 
 
 def find_or_create_community_resource(dataset_id, new_file, url, resource_format):
@@ -73,13 +65,30 @@ def find_or_create_community_resource(dataset_id, new_file, url, resource_format
     then we only update the file.
 
     Otherwise we create a new resource
+
+    Returns the community resource, or None if the existing community resource
+    already has the same file
     """
     community_resource = find_community_resources(
         dataset_id, new_file, url, resource_format
     )
     if community_resource is not None:
-        upload_resource(community_resource["id"], new_file)
-        return community_resource
+        try:
+            if _has_checksum(new_file, community_resource.get("checksum")):
+                # the index can be outdated, we check that the resource is still there
+                if datagouv.community_resource_exists(community_resource["id"]):
+                    return None
+            else:
+                return upload_resource(community_resource["id"], new_file)
+        except requests.HTTPError as err:
+            if err.response.status_code != 404:
+                raise
+        # the resource has been deleted without us knowing it
+        logging.warning(
+            "The community resource %s does not exist anymore",
+            community_resource["id"],
+        )
+        community_resources_index.remove(dataset_id, community_resource["id"])
     return datagouv.create_community_resource(dataset_id, new_file)
 
 
@@ -102,7 +111,7 @@ def update_resource_metadata(resource_id, additional_metadata, url):
     url = f"{DATAGOUV_API}/datasets/community_resources/{resource_id}/"
     headers = {"X-API-KEY": DATAGOUV_API_KEY}
 
-    ret = requests.put(url, headers=headers, json=resource)
+    ret = http_session.get_session().put(url, headers=headers, json=resource)
     ret.raise_for_status()
     logging.debug("Updating of resource %s done", resource_id)
 
@@ -112,13 +121,14 @@ def upload_resource(resource_id, filename):
     Replaces the file of an existing resource.
 
     After the call, and update to that resource is needed
+
+    Returns the updated resource
     """
     logging.debug("Uploading an new file %s on resource %s", filename, resource_id)
     url = f"{DATAGOUV_API}/datasets/community_resources/{resource_id}/upload/"
-    headers = {"X-API-KEY": DATAGOUV_API_KEY}
-    ret = requests.post(url, headers=headers, files={"file": open(filename, "rb")})
-    ret.raise_for_status()
+    resource = datagouv.upload_file(url, filename).json()
     logging.debug("Uploading done")
+    return resource
 
 
 def publish_to_datagouv(dataset_id, new_file, additional_metadata, url):
@@ -126,21 +136,40 @@ def publish_to_datagouv(dataset_id, new_file, additional_metadata, url):
     This will publish the converted file as a community resource of the dataset.
 
     If the community resource already existed, it will be updated
+    (only if the file is not the same as the published one)
     """
+    resource_format = additional_metadata["format"]
     try:
         logging.info(
             "Going to add the file %s as community ressource to the dataset %s",
             new_file,
             dataset_id,
         )
-        community_resource = find_or_create_community_resource(
-            dataset_id, new_file, url, resource_format=additional_metadata["format"]
-        )
-        update_resource_metadata(
-            community_resource["id"], additional_metadata, url
+        with job_metrics.span("upload"):
+            community_resource = find_or_create_community_resource(
+                dataset_id, new_file, url, resource_format=resource_format
+            )
+        if community_resource is None:
+            logging.info(
+                "%s is already published on the dataset %s, skipping it",
+                new_file,
+                dataset_id,
+            )
+            job_metrics.record_item("publish", resource_format, "skipped")
+            return
+        with job_metrics.span("metadata_update"):
+            update_resource_metadata(community_resource["id"], additional_metadata, url)
+        community_resources_index.add(
+            dataset_id,
+            url,
+            resource_format,
+            community_resource["id"],
+            community_resource.get("checksum"),
         )
         logging.info("Added %s to the dataset %s", new_file, dataset_id)
+        job_metrics.record_item("publish", resource_format, "published")
     except requests.HTTPError as err:
+        job_metrics.record_item("publish", resource_format, "failed")
         logging.warning(
             "Unable to add %s to the dataset %s. Http Error %s",
             new_file,
@@ -148,4 +177,5 @@ def publish_to_datagouv(dataset_id, new_file, additional_metadata, url):
             err,
         )
     except Exception as err:
+        job_metrics.record_item("publish", resource_format, "failed")
         logging.exception("Unable to add %s to the dataset %s", new_file, dataset_id)
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+
+def make_key(*parts):
+    """
+    Build a cache key (usable as a file name) from some strings
+    """
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    Size bounded LRU cache of files on disk.
+
+    The entries are moved into the cache with an atomic rename, so a cache directory
+    can be shared by all the processes of a node (like the different rq workers).
+
+    The last access of an entry is tracked with its mtime, and the least recently
+    used entries are evicted when the cache is bigger than `max_size` bytes.
+    The entries accessed less than `grace_period` seconds ago are never evicted,
+    so a file returned by the cache is not removed while a job is still using it.
+    """
+
+    def __init__(self, directory, max_size, grace_period=3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.grace_period = grace_period
+        self._tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, f"{key}.meta")
+
+    def tmp_file(self, mode="w+b"):
+        """
+        Returns a new temporary file in the cache directory.
+
+        The file can later be moved in the cache without any copy with `put`
+        """
+        return tempfile.NamedTemporaryFile(mode, dir=self._tmp_dir, delete=False)
+
+    def get(self, key):
+        """
+        Returns the path of the cached file, or None if it is not in the cache
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_copy(self, key, dest):
+        """
+        Copies the cached file to `dest` (the file is hard linked when possible)
+        and returns `dest`, or None if it is not in the cache
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            os.link(path, dest)
+        except FileNotFoundError:
+            # evicted in the meantime by another process
+            return None
+        except OSError:
+            # the cache is not on the same file system
+            shutil.copyfile(path, dest)
+        return dest
+
+    def put(self, key, src, move=True):
+        """
+        Adds the file `src` to the cache and returns its path in the cache.
+        """
+        path = self._path(key)
+        if not move:
+            with self.tmp_file() as tmp:
+                with open(src, "rb") as f:
+                    shutil.copyfileobj(f, tmp)
+            src = tmp.name
+        os.replace(src, path)
+        self.evict()
+        return path
+
+    def get_meta(self, key):
+        """
+        Returns the metadata (a dict) stored for the key, or None
+        """
+        try:
+            with open(self._meta_path(key)) as f:
+                meta = json.load(f)
+            os.utime(self._meta_path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta
+
+    def set_meta(self, key, meta):
+        with self.tmp_file("w") as tmp:
+            json.dump(meta, tmp)
+        os.replace(tmp.name, self._meta_path(key))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in `max_size`
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if not e.is_file():
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    # removed in the meantime by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.max_size:
+            return
+
+        too_recent = time.time() - self.grace_period
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size or mtime > too_recent:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            logging.debug(f"evicted {path} from cache")
@@ -0,0 +1,192 @@
+"""
+Writers of the merged features.
+
+Each sink receives the features one by one, encoded as one json per line
+(each line can start with the record separator of the GeoJSON text sequences),
+so the merged dataset can be written in the geojson formats in a single pass.
+"""
+import json
+import zipfile
+from osgeo import ogr, osr  # type: ignore
+
+# the features are written in the geopackage by batch of this size
+GEOPACKAGE_TRANSACTION_SIZE = 10000
+RECORD_SEPARATOR = b"\x1e"
+
+# types of the geopackage fields, a type can be widened to the types after it
+_BOOLEAN = 0
+_INTEGER = 1
+_REAL = 2
+_STRING = 3
+
+
+def _json(line):
+    """
+    Returns the json of the line, without its record separator
+    """
+    return line.lstrip(RECORD_SEPARATOR).rstrip(b"\n")
+
+
+def _attributes(feature):
+    return {
+        **{
+            k: v
+            for k, v in feature.items()
+            if k not in ("type", "geometry", "properties")
+        },
+        **(feature.get("properties") or {}),
+    }
+
+
+def _field_type(value):
+    if isinstance(value, bool):
+        return _BOOLEAN
+    if isinstance(value, int):
+        return _INTEGER
+    if isinstance(value, float):
+        return _REAL
+    return _STRING
+
+
+class _Sink:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ZipEntrySink(_Sink):
+    """
+    Writes the features in a compressed file of a new zip archive
+    """
+
+    def __init__(self, path, entry_name):
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        self._entry = self._zip.open(entry_name, "w", force_zip64=True)
+
+    def close(self):
+        self._entry.close()
+        self._zip.close()
+
+
+class GeoJSONSeqZipSink(_ZipEntrySink):
+    """
+    Zipped GeoJSONSeq file, with one feature per line
+    """
+
+    def write(self, line):
+        self._entry.write(line)
+
+
+class GeoJSONZipSink(_ZipEntrySink):
+    """
+    Zipped GeoJSON file, with all the features in one FeatureCollection
+    """
+
+    def __init__(self, path, entry_name):
+        super().__init__(path, entry_name)
+        self._entry.write(b'{"type": "FeatureCollection", "features": [\n')
+        self._empty = True
+
+    def write(self, line):
+        if not self._empty:
+            self._entry.write(b",\n")
+        self._entry.write(_json(line))
+        self._empty = False
+
+    def close(self):
+        self._entry.write(b"\n]}\n")
+        super().close()
+
+
+class GeoPackageSchema:
+    """
+    Types of the attributes of the features, to be known before writing the geopackage.
+
+    When an attribute has different types in the features, its type is widened:
+    mixed booleans and numbers are stored as numbers, and all the other mixes as strings.
+    The geopackage column names are case insensitive, so are the attributes.
+    """
+
+    def __init__(self):
+        # lower case name -> (name, type)
+        self.fields = {}
+
+    def write(self, line):
+        for name, value in _attributes(json.loads(_json(line))).items():
+            if value is None:
+                continue
+            field_type = _field_type(value)
+            known = self.fields.get(name.lower())
+            if known is None:
+                self.fields[name.lower()] = (name, field_type)
+            elif known[1] != field_type:
+                if _STRING in (known[1], field_type):
+                    self.fields[name.lower()] = (known[0], _STRING)
+                else:
+                    self.fields[name.lower()] = (known[0], max(known[1], field_type))
+
+
+class GeoPackageSink(_Sink):
+    """
+    GeoPackage file, with all the features in one layer.
+
+    The attributes of the layer are created with the types of the `schema`
+    """
+
+    def __init__(self, path, layer_name, schema):
+        self._datasource = ogr.GetDriverByName("GPKG").CreateDataSource(path)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        self._layer = self._datasource.CreateLayer(layer_name, srs, ogr.wkbUnknown)
+        self._fields = {}
+        for key, (name, field_type) in schema.fields.items():
+            self._create_field(name, field_type)
+            self._fields[key] = field_type
+        self._nb_features = 0
+        self._datasource.StartTransaction()
+
+    def _create_field(self, name, field_type):
+        if field_type == _BOOLEAN:
+            field = ogr.FieldDefn(name, ogr.OFTInteger)
+            field.SetSubType(ogr.OFSTBoolean)
+        elif field_type == _INTEGER:
+            field = ogr.FieldDefn(name, ogr.OFTInteger64)
+        elif field_type == _REAL:
+            field = ogr.FieldDefn(name, ogr.OFTReal)
+        else:
+            field = ogr.FieldDefn(name, ogr.OFTString)
+        self._layer.CreateField(field)
+
+    def write(self, line):
+        feature = json.loads(_json(line))
+        ogr_feature = ogr.Feature(self._layer.GetLayerDefn())
+        if feature.get("geometry"):
+            ogr_feature.SetGeometry(
+                ogr.CreateGeometryFromJson(json.dumps(feature["geometry"]))
+            )
+        for name, value in _attributes(feature).items():
+            field_type = self._fields.get(name.lower())
+            if value is None or field_type is None:
+                continue
+            if field_type == _STRING:
+                if not isinstance(value, str):
+                    value = json.dumps(value)
+            elif field_type == _REAL:
+                value = float(value)
+            else:
+                value = int(value)
+            ogr_feature.SetField(name, value)
+        self._layer.CreateFeature(ogr_feature)
+
+        self._nb_features += 1
+        if self._nb_features % GEOPACKAGE_TRANSACTION_SIZE == 0:
+            self._datasource.CommitTransaction()
+            self._datasource.StartTransaction()
+
+    def close(self):
+        self._datasource.CommitTransaction()
+        # the datasource is written when it is dereferenced
+        self._layer = None
+        self._datasource = None
@@ -4,8 +4,12 @@ import logging
 import re
 import shutil
 import utils
+import job_metrics
 
 GEOJSON_CONVERTER = os.environ["GEOJSON_CONVERTER"]
+# the conversion is stopped before the 30mn timeout of the job if it starts soon enough,
+# otherwise it is killed when the job is stopped (see jobs.convert)
+GEOJSON_LIMITS = utils.ResourceLimits.from_env("GEOJSON", default_wall_time=25 * 60)
 
 
 def convert(gtfs_src, fname, tmp_dir):
@@ -15,9 +19,11 @@ def convert(gtfs_src, fname, tmp_dir):
     logging.info(f"Start converting {gtfs_src} to geojson {tmp_dir}")
 
     output = f"{tmp_dir}/{fname}.geojson"
-    ret = utils.run_command(
-        [GEOJSON_CONVERTER, "--input", gtfs_src, "--output", output]
-    )
+    with job_metrics.span("conversion"):
+        ret = utils.run_command(
+            [GEOJSON_CONVERTER, "--input", gtfs_src, "--output", output],
+            limits=GEOJSON_LIMITS,
+        )
     logging.debug(f"Conversion done with return code {ret}")
     if ret == 0:
         return output
@@ -26,4 +32,9 @@ def convert(gtfs_src, fname, tmp_dir):
 
 
 def convert_sync(gtfs_src):
-    return utils.run_command_get_stdout([GEOJSON_CONVERTER, "--input", gtfs_src])
+    """
+    Converts a given gtfs file, and yields the geojson by chunks
+    """
+    return utils.stream_command_stdout(
+        [GEOJSON_CONVERTER, "--input", gtfs_src], limits=GEOJSON_LIMITS
+    )
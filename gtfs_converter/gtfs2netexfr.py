@@ -1,34 +1,45 @@
 import os
 import logging
-import shutil
 import utils
+import archive
+import job_metrics
 
 NETEX_CONVERTER = os.environ["NETEX_CONVERTER"]
 PUBLISHER = os.environ.get("NETEX_PUBLISHER", "transport.data.gouv.fr")
+NETEX_COMPRESSION_LEVEL = int(os.environ.get("NETEX_COMPRESSION_LEVEL", 6))
+# the conversion is stopped before the 30mn timeout of the job if it starts soon enough,
+# otherwise it is killed when the job is stopped (see jobs.convert)
+NETEX_LIMITS = utils.ResourceLimits.from_env("NETEX", default_wall_time=25 * 60)
 
 
 def convert(gtfs_src, fname, netex_dir):
     """
-    Converts a given gtfs file and returns the path to the generated netex zip file.
+    Converts a given gtfs file and returns the path to the generated netex zip file
+    (in `netex_dir`).
     The publisher is the name of the organization that published that dataset.
     """
     logging.info(f"Start converting {gtfs_src} to {netex_dir}")
 
-    ret = utils.run_command(
-        [
-            NETEX_CONVERTER,
-            "--input",
-            gtfs_src,
-            "--output",
-            netex_dir,
-            "--participant",
-            PUBLISHER,
-        ]
-    )
+    output_dir = os.path.join(netex_dir, "netex")
+    os.makedirs(output_dir)
+    with job_metrics.span("conversion"):
+        ret = utils.run_command(
+            [
+                NETEX_CONVERTER,
+                "--input",
+                gtfs_src,
+                "--output",
+                output_dir,
+                "--participant",
+                PUBLISHER,
+            ],
+            limits=NETEX_LIMITS,
+        )
     logging.debug(f"Conversion done with return code {ret}")
     if ret == 0:
-        netex_zip = f"{fname}.netex"
-        shutil.make_archive(netex_zip, "zip", netex_dir)
-        return f"{netex_zip}.zip"
+        netex_zip = os.path.join(netex_dir, f"{fname}.netex.zip")
+        with job_metrics.span("archive"):
+            archive.make_zip(netex_zip, output_dir, NETEX_COMPRESSION_LEVEL)
+        return netex_zip
 
     raise Exception("Unable to convert file")
@@ -0,0 +1,170 @@
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import rate_limiter
+import metrics
+
+# timeout (in seconds) to establish a connection, and to wait for some data from the server
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 300))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 5))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", 0.5))
+# number of connections kept alive for each host
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+# the requests on this API are rate limited
+DATAGOUV_API = os.environ.get("DATAGOUV_API")
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+
+
+def _jitter(backoff):
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class _JitteredRetry(Retry):
+    """
+    Retry with an exponential backoff, with some jitter so that
+    the clients throttled at the same time do not retry at the same time.
+
+    POST requests are not idempotent, they are only retried on 429 responses
+    (the request has not been processed by the server), and only if `retry_post` is set
+    """
+
+    def __init__(self, retry_post=True, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_post = retry_post
+
+    def new(self, **kwargs):
+        new_retry = super().new(**kwargs)
+        new_retry.retry_post = self.retry_post
+        return new_retry
+
+    def get_backoff_time(self):
+        return _jitter(super().get_backoff_time())
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code == 429:
+            return self.retry_post and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def _endpoint_class(method):
+    if method == "DELETE":
+        return "delete"
+    if method in ("POST", "PUT", "PATCH"):
+        return "upload"
+    return "read"
+
+
+class _RateLimitedRetry(_JitteredRetry):
+    """
+    Retry waiting for the shared rate limiter before each retry
+    (the retries are done by urllib3, without going through the adapter)
+    """
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        rate_limiter.acquire(_endpoint_class(self.history[-1].method))
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with a default timeout
+    """
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        return super().send(request, **kwargs)
+
+
+class _RateLimitedHTTPAdapter(_TimeoutHTTPAdapter):
+    """
+    HTTPAdapter waiting for the shared rate limiter before sending the requests
+    (its retries need to be a _RateLimitedRetry to be limited too)
+    """
+
+    def send(self, request, **kwargs):
+        rate_limiter.acquire(_endpoint_class(request.method))
+        start = time.monotonic()
+        status = "error"
+        try:
+            response = super().send(request, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.DATAGOUV_REQUEST_DURATION.labels(request.method, status).observe(
+                time.monotonic() - start
+            )
+
+
+def backoff_time(attempt):
+    """
+    Returns the time to wait before retrying, for the requests that are retried by hand
+    """
+    return _jitter(min(Retry.BACKOFF_MAX, HTTP_BACKOFF_FACTOR * (2 ** attempt)))
+
+
+def _make_session(retry_post):
+    session = requests.Session()
+    retry_params = dict(
+        retry_post=retry_post,
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # after the last retry we want the response, to raise a requests.HTTPError
+        raise_on_status=False,
+    )
+    adapter = _TimeoutHTTPAdapter(
+        pool_maxsize=HTTP_POOL_SIZE, max_retries=_JitteredRetry(**retry_params)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if DATAGOUV_API:
+        session.mount(
+            DATAGOUV_API,
+            _RateLimitedHTTPAdapter(
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=_RateLimitedRetry(**retry_params),
+            ),
+        )
+    return session
+
+
+def _get_session(name, retry_post):
+    global _sessions_pid
+    with _lock:
+        # the rq workers fork for each job, the connections cannot be shared with the parent
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if name not in _sessions:
+            _sessions[name] = _make_session(retry_post)
+        return _sessions[name]
+
+
+def get_session():
+    """
+    Returns the http session shared by the process.
+
+    The connections are kept alive and reused, the requests have a default timeout
+    and are retried with a jittered backoff on connection errors, 429 and 5xx responses.
+    """
+    return _get_session("default", retry_post=True)
+
+
+def get_upload_session():
+    """
+    Returns the http session used for the streamed uploads.
+
+    A streamed body cannot be sent again by the retry mechanism,
+    so the POST requests on this session are never retried on 429 responses,
+    the retry needs to be done by the caller (with `backoff_time`).
+    """
+    return _get_session("upload", retry_post=False)
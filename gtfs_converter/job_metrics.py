@@ -0,0 +1,82 @@
+"""
+Metrics of the running job, stored in the meta of the rq job
+"""
+import time
+import threading
+import contextlib
+import rq  # type: ignore
+import metrics
+
+_lock = threading.Lock()
+_job = None
+# conversion of the span being run by the thread, inherited by the nested spans
+_current = threading.local()
+
+
+def init():
+    """
+    Needs to be called at the start of the job, in the main thread.
+
+    rq only knows the current job in the thread running it, but the job's
+    conversions are run in other threads.
+    Each rq job is run in its own process, so the job can be shared by the whole process.
+    """
+    global _job
+    _job = rq.get_current_job()
+
+
+def append(name, value):
+    """
+    Appends `value` to the `name` list of the job's meta
+    (does nothing outside of a job)
+    """
+    if _job is None:
+        return
+    with _lock:
+        _job.meta.setdefault(name, []).append(value)
+        _job.save_meta()
+
+
+def record_item(name, key, value):
+    """
+    Records `value` in the `name` dict of the job's meta
+    (does nothing outside of a job)
+    """
+    if _job is None:
+        return
+    with _lock:
+        _job.meta.setdefault(name, {})[key] = value
+        _job.save_meta()
+
+
+@contextlib.contextmanager
+def span(stage, conversion=None):
+    """
+    Times a stage of the job, the span is appended to the `spans` list of the job's meta
+    and its duration is exported in the metrics.
+
+    Without `conversion`, the span is part of the conversion of the enclosing span
+    """
+    if conversion is None:
+        conversion = getattr(_current, "conversion", "")
+    previous_conversion = getattr(_current, "conversion", "")
+    _current.conversion = conversion
+    start = time.time()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        _current.conversion = previous_conversion
+        duration = time.time() - start
+        metrics.STAGE_DURATION.labels(stage, conversion).observe(duration)
+        append(
+            "spans",
+            {
+                "stage": stage,
+                "conversion": conversion,
+                "start": start,
+                "duration": duration,
+                "status": status,
+            },
+        )
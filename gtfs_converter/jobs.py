@@ -1,39 +1,133 @@
+import os
 import logging
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pylogctx import context as log_context  # type: ignore
 
 import utils
+import job_metrics
+import queues
 import gtfs2netexfr
 import gtfs2geojson
+from disk_cache import DiskCache, make_key
 from datagouv_publisher import publish_to_datagouv
 
+RESULT_CACHE_DIR = os.environ.get(
+    "RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "conversion_results")
+)
+RESULT_CACHE_MAX_SIZE = int(os.environ.get("RESULT_CACHE_MAX_SIZE", 10 * 1024 ** 3))
+# maximum number of conversions run at the same time for a job
+CONVERSION_CONCURRENCY = int(os.environ.get("CONVERSION_CONCURRENCY", 2))
+
+_result_cache = None
+
+
+def _get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = DiskCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_SIZE)
+    return _result_cache
+
 
 def convert(params):
     with log_context(task_id=params["datagouv_id"]):
+        job_metrics.init()
         try:
             logging.info(
                 f"Dequeing {params['url']} for datagouv_id {params['datagouv_id']} and {params['conversion_type']} conversions"
             )
 
-            gtfs, fname = utils.download_gtfs(params["url"])
+            with job_metrics.span("download"):
+                gtfs, fname, gtfs_checksum = utils.download_gtfs(params["url"])
+            queues.record_feed_size(params["url"], os.path.getsize(gtfs))
+
+            converters = {
+                "gtfs2netex": _convert_to_netex,
+                "gtfs2geojson": _convert_to_geojson,
+            }
+            # the conversions are independent, so we run them in parallel
+            with ThreadPoolExecutor(max_workers=CONVERSION_CONCURRENCY) as executor:
+                futures = {
+                    conversion: executor.submit(
+                        _run_conversion,
+                        conversion,
+                        converters[conversion],
+                        gtfs,
+                        fname,
+                        gtfs_checksum,
+                        params["datagouv_id"],
+                        params["url"],
+                    )
+                    for conversion in params["conversion_type"]
+                    if conversion in converters
+                }
 
-            for conversion in params["conversion_type"]:
-                if conversion == "gtfs2netex":
-                    _convert_to_netex(gtfs, fname, params["datagouv_id"], params["url"])
-                if conversion == "gtfs2geojson":
-                    _convert_to_geojson(
-                        gtfs, fname, params["datagouv_id"], params["url"]
+            failed = []
+            for conversion, future in futures.items():
+                error = future.exception()
+                if error is None:
+                    logging.info(f"{conversion} conversion done")
+                    continue
+                failed.append(conversion)
+                if isinstance(error, utils.ResourceExceededError):
+                    logging.error(f"{conversion} conversion failed: {error}")
+                    job_metrics.record_item(
+                        "failures", conversion, f"{error.resource_name} exceeded"
                     )
+                else:
+                    logging.error(f"{conversion} conversion failed", exc_info=error)
+                    job_metrics.record_item("failures", conversion, "error")
+            if failed:
+                raise Exception(f"{failed} conversion(s) failed")
 
             logging.info("job finished")
         except:
             logging.exception("job failed")
+            # the converters are not stopped with the job (on a timeout for example),
+            # they would keep running after it
+            utils.kill_running_commands()
             raise
 
 
-def _convert_to_netex(gtfs, file_name, datagouv_id, url):
+def _run_conversion(
+    conversion, convert_func, gtfs, file_name, gtfs_checksum, datagouv_id, url
+):
+    # the log context is local to a thread, we need to set it again
+    with log_context(task_id=datagouv_id), job_metrics.span("total", conversion):
+        convert_func(gtfs, file_name, gtfs_checksum, datagouv_id, url)
+
+
+def _memoized_conversion(fingerprint, output, convert_file):
+    """
+    Returns the path of the converted file, stored as `output`.
+
+    The converted files are kept in a cache indexed by the fingerprint of the conversion
+    (the hash of the input, the version of the converter and its parameters),
+    so the conversion is skipped if the same input has already been converted.
+    """
+    cache = _get_result_cache()
+    key = make_key(*fingerprint)
+    if cache.get_copy(key, output):
+        logging.info("The file has already been converted, reusing the result")
+        return output
+
+    converted = convert_file()
+    cache.put(key, converted, move=False)
+    return converted
+
+
+def _convert_to_netex(gtfs, file_name, gtfs_checksum, datagouv_id, url):
     with tempfile.TemporaryDirectory() as netex_dir:
-        netex = gtfs2netexfr.convert(gtfs, file_name, netex_dir)
+        netex = _memoized_conversion(
+            [
+                "netex",
+                gtfs_checksum,
+                utils.converter_version(gtfs2netexfr.NETEX_CONVERTER),
+                gtfs2netexfr.PUBLISHER,
+            ],
+            os.path.join(netex_dir, f"{file_name}.netex.zip"),
+            lambda: gtfs2netexfr.convert(gtfs, file_name, netex_dir),
+        )
         logging.debug(f"Got a netex file: {netex}")
         metadata = {
             "description": """Conversion automatique du fichier GTFS au format NeTEx (profil France)
@@ -43,12 +137,21 @@ La conversion est effectuée par transport.data.gouv.fr en utilisant l’outil h
             "format": "NeTEx",
             "mime": "application/zip",
         }
-        publish_to_datagouv(datagouv_id, netex, metadata, url)
+        with job_metrics.span("publish"):
+            publish_to_datagouv(datagouv_id, netex, metadata, url)
 
 
-def _convert_to_geojson(gtfs, file_name, datagouv_id, url):
+def _convert_to_geojson(gtfs, file_name, gtfs_checksum, datagouv_id, url):
     with tempfile.TemporaryDirectory() as tmp_dir:
-        geojson = gtfs2geojson.convert(gtfs, file_name, tmp_dir)
+        geojson = _memoized_conversion(
+            [
+                "geojson",
+                gtfs_checksum,
+                utils.converter_version(gtfs2geojson.GEOJSON_CONVERTER),
+            ],
+            os.path.join(tmp_dir, f"{file_name}.geojson"),
+            lambda: gtfs2geojson.convert(gtfs, file_name, tmp_dir),
+        )
         logging.debug(f"Got a geojson file: {geojson}")
         metadata = {
             "description": """Création automatique d'un fichier geojson à partir du fichier GTFS.
@@ -58,4 +161,5 @@ Le fichier est généré par transport.data.gouv.fr en utilisant l'outil https:/
             "format": "geojson",
             "mime": "application/json",
         }
-        publish_to_datagouv(datagouv_id, geojson, metadata, url)
+        with job_metrics.span("publish"):
+            publish_to_datagouv(datagouv_id, geojson, metadata, url)
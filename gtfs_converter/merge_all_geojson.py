@@ -1,77 +1,229 @@
-import utils
 from jsonseq.encode import JSONSeqEncoder
 import requests
 import gzip
+import ijson
+import hashlib
+import contextlib
 import logging
 import tempfile
+import threading
+import collections
 import os
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import datagouv
+import catalog
+import http_session
+import feature_sinks
+import metrics
+from disk_cache import DiskCache, make_key
 from pylogctx import context as log_context
 
 AGGREGATED_DATASET_ID = os.environ["AGGREGATED_DATASET_ID"]
+# number of resources downloaded at the same time
+MERGE_FETCH_CONCURRENCY = int(os.environ.get("MERGE_FETCH_CONCURRENCY", 8))
+# number of resources downloaded at the same time from the same host
+MERGE_FETCH_PER_HOST = int(os.environ.get("MERGE_FETCH_PER_HOST", 4))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MERGE_CACHE_DIR = os.environ.get(
+    "MERGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "merge_cache")
+)
+MERGE_CACHE_MAX_SIZE = int(os.environ.get("MERGE_CACHE_MAX_SIZE", 5 * 1024 ** 3))
 
 
 def _get_all_transport_geojson_resources():
-    r = requests.get("https://transport.data.gouv.fr/api/datasets")
-    r.raise_for_status()
-    datasets = r.json()
-    resources = []
-    for d in datasets:
-        if d["type"] != "public-transit":
-            continue
-        for r in d["community_resources"]:
-            url = r.get("url")
-            if not url:
-                continue
-            if (
-                r["community_resource_publisher"]
-                != "Point d'Accès National transport.data.gouv.fr"
-            ):
-                continue
-            if r["format"] != "geojson":
-                continue
+    resources = [
+        {
+            "resource_url": r["url"],
+            "datagouv_dataset_id": d["id"],
+            "dataset_title": d["title"],
+        }
+        for d, r in catalog.get_catalog().community_resources(
+            catalog.PAN_PUBLISHER, "geojson"
+        )
+        if r.get("url")
+    ]
+    logging.info(f"there are {len(resources)} geojson")
+    return resources
+
+
+class _ResourceFetcher:
+    """
+    Downloads the resources with a shared connection pool,
+    limiting the number of concurrent downloads on each host.
+
+    The annotated features of each resource are kept in a cache, indexed by the resource
+    url and its annotations, so only the resources that have changed are processed again.
+    """
+
+    def __init__(self):
+        self._session = http_session.get_session()
+        self._hosts_semaphores = collections.defaultdict(
+            lambda: threading.BoundedSemaphore(MERGE_FETCH_PER_HOST)
+        )
+        self._lock = threading.Lock()
+        self._cache = DiskCache(MERGE_CACHE_DIR, MERGE_CACHE_MAX_SIZE)
+
+    def _host_semaphore(self, url):
+        with self._lock:
+            return self._hosts_semaphores[urllib.parse.urlsplit(url).netloc]
+
+    def get_block(self, resource, directory):
+        """
+        Returns the path of a file with the annotated features of the resource,
+        one feature per line.
+
+        Returns None if the resource cannot be downloaded
+        """
+        url = resource["resource_url"]
+        key = make_key("geojson", *(f"{k}={v}" for k, v in sorted(resource.items())))
+        cached = self._cache.get_meta(key)
+        block = self._cache.get(key) if cached else None
 
-            resources.append(
-                {
-                    "resource_url": url,
-                    "datagouv_dataset_id": d["id"],
-                    "dataset_title": d["title"],
+        headers = {}
+        if block:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with log_context(task_id="merge_geojson"):
+            with tempfile.NamedTemporaryFile(dir=directory) as tmp:
+                with self._host_semaphore(url):
+                    try:
+                        with self._session.get(url, headers=headers, stream=True) as r:
+                            if r.status_code == requests.codes.not_modified and block:
+                                return block
+                            if r.status_code != requests.codes.ok:
+                                logging.warning(
+                                    f"impossible to get {url}: {r.status_code}"
+                                )
+                                return None
+                            sha256 = hashlib.sha256()
+                            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                sha256.update(chunk)
+                                tmp.write(chunk)
+                                metrics.DOWNLOADED_BYTES.inc(len(chunk))
+                            tmp.flush()
+                    except requests.RequestException as e:
+                        logging.warning(f"impossible to get {url}: {e}")
+                        return None
+
+                meta = {
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "sha256": sha256.hexdigest(),
                 }
+                if not block or cached.get("sha256") != meta["sha256"]:
+                    logging.debug(f"{url} has changed, processing it")
+                    block = self._build_block(key, resource, tmp.name)
+                if block:
+                    self._cache.set_meta(key, meta)
+                return block
+
+    def _build_block(self, key, resource, resource_file):
+        """
+        Returns the path of the cached block of the resource's features,
+        None if the resource is not a valid geojson (a partial block is not kept)
+        """
+        with self._cache.tmp_file("w") as block:
+            try:
+                for chunk in JSONSeqEncoder().iterencode(
+                    _get_features(resource, resource_file)
+                ):
+                    block.write(chunk)
+            except ijson.JSONError:
+                logging.warning(f"{resource['resource_url']} is not a valid json")
+                os.remove(block.name)
+                return None
+        return self._cache.put(key, block.name)
+
+
+def _fetch_all(resources, directory):
+    """
+    Gets the blocks of annotated features of the resources in parallel.
+
+    Yields the resources with their block, in the same order as the resources.
+    Only a bounded number of resources are processed in advance.
+    """
+    fetcher = _ResourceFetcher()
+    with ThreadPoolExecutor(max_workers=MERGE_FETCH_CONCURRENCY) as executor:
+        pending = collections.deque()
+        for resource in resources:
+            pending.append(
+                (resource, executor.submit(fetcher.get_block, resource, directory))
             )
-    logging.info(f"there are {len(resources)} geojson")
-    return resources
+            if len(pending) >= 2 * MERGE_FETCH_CONCURRENCY:
+                resource, future = pending.popleft()
+                yield resource, future.result()
+        while pending:
+            resource, future = pending.popleft()
+            yield resource, future.result()
+
 
+def _get_features(resource, resource_file):
+    """
+    Yields the features of the geojson one by one, without loading the whole file in memory.
 
-def _get_features(resource):
-    url = resource["resource_url"]
-    r = requests.get(url)
-    if r.status_code != requests.codes.ok:
-        return []
-    geojson = r.json()
-    for f in geojson.get("features", []):
-        # we add some metadata on each feature
-        f.update(resource)
-        yield f
+    Raises an ijson.JSONError if the file is not a valid json
+    """
+    with open(resource_file, "rb") as f:
+        for feature in ijson.items(f, "features.item", use_float=True):
+            # we add some metadata on each feature
+            feature.update(resource)
+            yield feature
 
 
-def _create_merged_geojson_line(directory):
+def _create_merged_files(directory):
     """
-    Merge all geojson on transport.data.gouv.fr to create an aggregated dataset with one geojson per line
+    Merge all geojson on transport.data.gouv.fr to create an aggregated dataset.
+
+    Each feature is written at the same time in a zipped geojson line (with one geojson per line)
+    and a zipped geojson, while the types of its attributes are collected.
+    The geopackage is then written from the cached blocks, once all the types are known.
     """
     logging.info("creating a big file for all french datasets")
 
     cpt = 0
+    geojson_line_zip = f"{directory}/public-transit.geojsonl.zip"
+    geojson_zip = f"{directory}/public-transit.geojson.zip"
+    geopackage = f"{directory}/public-transit.gpkg"
 
-    output_file_path = f"{directory}/public-transit.geojsonl"
-    with open(output_file_path, "w") as outfile:
-        for resource in _get_all_transport_geojson_resources():
-            for chunk in JSONSeqEncoder().iterencode(_get_features(resource)):
-                outfile.write(chunk)
+    schema = feature_sinks.GeoPackageSchema()
+    blocks = []
+    with contextlib.ExitStack() as stack:
+        sinks = [
+            stack.enter_context(
+                feature_sinks.GeoJSONSeqZipSink(
+                    geojson_line_zip, "public-transit.geojsonl"
+                )
+            ),
+            stack.enter_context(
+                feature_sinks.GeoJSONZipSink(geojson_zip, "public-transit.geojson")
+            ),
+            schema,
+        ]
+        for resource, block in _fetch_all(
+            _get_all_transport_geojson_resources(), directory
+        ):
+            if block is None:
+                continue
+            blocks.append(block)
+            with open(block, "rb") as f:
+                for line in f:
+                    for sink in sinks:
+                        sink.write(line)
 
             cpt += 1
 
+    with feature_sinks.GeoPackageSink(geopackage, "public-transit", schema) as sink:
+        for block in blocks:
+            with open(block, "rb") as f:
+                for line in f:
+                    sink.write(line)
+
     logging.info(f"{cpt} files read")
-    return output_file_path
+    return geojson_zip, geojson_line_zip, geopackage
 
 
 def _publish_to_datagouv(ziped_geojson, ziped_geojson_line, geopackage):
@@ -123,28 +275,14 @@ def merge_geojson():
 
     and publish those resources on data.gouv
     """
-    with log_context(task_id="merge_geojson"):
+    with log_context(task_id="merge_geojson"), metrics.MERGE_DURATION.time():
         with tempfile.TemporaryDirectory() as tmp_dir:
-            geojson_line_file = _create_merged_geojson_line(tmp_dir)
-            logging.info(f"geojson line created: {geojson_line_file}")
-
-            geopackage_file = f"{tmp_dir}/public-transit.gpkg"
-            geojson_file = f"{tmp_dir}/public-transit.geojson"
-            utils.run_command(
-                ["ogr2ogr", geopackage_file, f"GeoJSONSeq:{geojson_line_file}"]
-            )
-
-            ziped_geojson_file = f"{geojson_file}.zip"
-            ziped_geojson_line_file = f"{geojson_line_file}.zip"
-            utils.run_command(
-                ["ogr2ogr", geojson_file, f"GeoJSONSeq:{geojson_line_file}"]
-            )
-            utils.run_command(
-                ["zip", "--junk-paths", f"{ziped_geojson_file}", geojson_file]
-            )
-            utils.run_command(
-                ["zip", "--junk-paths", f"{ziped_geojson_line_file}", geojson_line_file]
-            )
+            (
+                ziped_geojson_file,
+                ziped_geojson_line_file,
+                geopackage_file,
+            ) = _create_merged_files(tmp_dir)
+            logging.info("merged files created")
 
             _publish_to_datagouv(
                 ziped_geojson_file, ziped_geojson_line_file, geopackage_file
@@ -0,0 +1,228 @@
+"""
+Prometheus metrics of the api, the workers and the scheduled tasks.
+
+The workers fork a process for each job, so the metrics are aggregated
+with the multiprocess mode of prometheus_client: the environment variable
+`prometheus_multiproc_dir` must be set to a directory shared by all the processes.
+The processes of several hosts (or containers) can share it, their files
+are named after the host and the pid.
+Each work horse leaves its files (of 1MB at least) after its end,
+so the worker merges them regularly in the files of the host (with the pid 0).
+Without it, only the metrics of the current process are exposed.
+"""
+import os
+import re
+import fcntl
+import socket
+import logging
+from collections import defaultdict
+from prometheus_client import (  # type: ignore
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client import multiprocess, values  # type: ignore
+from prometheus_client.mmap_dict import MmapedDict  # type: ignore
+from prometheus_client.core import GaugeMetricFamily  # type: ignore
+import redis
+import queues
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+MULTIPROC_DIR = os.environ.get("prometheus_multiproc_dir")
+
+
+def _process_identifier():
+    # the containers have their own pids, the same pid can be used in several of them
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+if MULTIPROC_DIR:
+    # needs to be set before the creation of the metrics
+    values.ValueClass = values.MultiProcessValue(_process_identifier)
+
+# the conversions can last tens of minutes
+_LONG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600, float("inf"))
+
+STAGE_DURATION = Histogram(
+    "gtfs_converter_stage_duration_seconds",
+    "Duration of the stages of the conversion jobs",
+    ["stage", "conversion"],
+    buckets=_LONG_BUCKETS,
+)
+COMMAND_EXITS = Counter(
+    "gtfs_converter_command_exits",
+    "Exit codes of the external commands",
+    ["command", "return_code"],
+)
+DOWNLOADED_BYTES = Counter(
+    "gtfs_converter_downloaded_bytes", "Bytes downloaded from the producers"
+)
+UPLOADED_BYTES = Counter(
+    "gtfs_converter_uploaded_bytes", "Bytes uploaded on data.gouv.fr"
+)
+DATAGOUV_REQUEST_DURATION = Histogram(
+    "gtfs_converter_datagouv_request_duration_seconds",
+    "Duration of the requests on the data.gouv.fr api",
+    ["method", "status"],
+)
+MERGE_DURATION = Histogram(
+    "gtfs_converter_merge_duration_seconds",
+    "Duration of the geojson merge task",
+    buckets=_LONG_BUCKETS,
+)
+
+
+class _QueueDepthCollector:
+    """
+    Number of jobs waiting in each queue, read in redis when the metrics are collected
+    """
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            "gtfs_converter_queue_depth",
+            "Number of jobs waiting in the queue",
+            labels=["queue"],
+        )
+        try:
+            for queue in queues.worker_queues():
+                depth.add_metric([queue.name], len(queue))
+        except redis.RedisError as e:
+            logging.warning(f"impossible to read the depth of the queues: {e}")
+            return []
+        return [depth]
+
+
+def _make_registry():
+    if not MULTIPROC_DIR:
+        registry = REGISTRY
+    else:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    registry.register(_QueueDepthCollector())
+    return registry
+
+
+_registry = None
+
+
+def _get_registry():
+    global _registry
+    if _registry is None:
+        _registry = _make_registry()
+    return _registry
+
+
+# the values of these metrics are summed over the processes
+_SUMMED_TYPES = ("counter", "histogram", "summary")
+# pid of the files in which the metrics of the dead processes are merged
+_HOST_PID = 0
+
+
+def _host_files():
+    """
+    Returns the metrics files of the processes of this host, as (path, prefix, pid) tuples
+    """
+    # the hostname needs to be followed by the pid only, `worker-1` must not match `worker-1-2`
+    pattern = re.compile(rf"(.+)_{re.escape(socket.gethostname())}-(\d+)\.db")
+    files = []
+    for name in os.listdir(MULTIPROC_DIR):
+        match = pattern.fullmatch(name)
+        if match:
+            path = os.path.join(MULTIPROC_DIR, name)
+            files.append((path, match.group(1), int(match.group(2))))
+    return files
+
+
+def clear_host_files():
+    """
+    Removes the metrics files of the previous processes of this host.
+
+    Needs to be called when the host (or container) starts, before the other processes
+    """
+    if not MULTIPROC_DIR:
+        return
+    for path, _, pid in _host_files():
+        if pid != os.getpid():
+            os.remove(path)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge_files(paths, target):
+    """
+    Replaces `target` by a file with the sum of the values of the files
+    """
+    totals = defaultdict(float)
+    for path in paths:
+        for key, value, _ in MmapedDict.read_all_values_from_file(path):
+            totals[key] += value
+    tmp_path = os.path.join(MULTIPROC_DIR, f".{os.path.basename(target)}.tmp")
+    merged = MmapedDict(tmp_path)
+    try:
+        for key, value in totals.items():
+            merged.write_value(key, value)
+    finally:
+        merged.close()
+    # the files are read at any time by the collector, so the merged file is renamed
+    # and the merged files are removed right after, to keep the gap as short as possible
+    os.replace(tmp_path, target)
+
+
+def compact_host_files():
+    """
+    Merges the metrics files of the dead processes of this host in the files of the host
+    """
+    if not MULTIPROC_DIR:
+        return
+    host = socket.gethostname()
+    with open(os.path.join(MULTIPROC_DIR, f".{host}.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another process of the host is already doing it
+            return
+
+        dead_files = defaultdict(list)
+        for path, prefix, pid in _host_files():
+            if pid in (_HOST_PID, os.getpid()) or _is_alive(pid):
+                continue
+            if prefix in _SUMMED_TYPES:
+                dead_files[prefix].append(path)
+            else:
+                # the gauges of the dead processes are not kept
+                multiprocess.mark_process_dead(f"{host}-{pid}", MULTIPROC_DIR)
+
+        for prefix, paths in dead_files.items():
+            target = os.path.join(MULTIPROC_DIR, f"{prefix}_{host}-{_HOST_PID}.db")
+            sources = paths + [target] if os.path.exists(target) else paths
+            _merge_files(sources, target)
+            for path in paths:
+                os.remove(path)
+        if dead_files:
+            logging.debug(f"metrics files merged: {dict(dead_files)}")
+
+
+def latest():
+    """
+    Returns the metrics in the prometheus text format, and their content type
+    """
+    return generate_latest(_get_registry()), CONTENT_TYPE_LATEST
+
+
+def serve():
+    """
+    Serves the metrics over http, for the processes that do not have an http server
+    """
+    start_http_server(METRICS_PORT, registry=_get_registry())
@@ -0,0 +1,18 @@
+"""
+Sidecar of the workers, serving the metrics aggregated from all the worker processes
+"""
+import time
+import logging
+import init_log
+import metrics
+
+
+if __name__ == "__main__":
+    init_log.config_worker_log()
+    metrics.serve()
+    logging.info(
+        f"serving the metrics on port {metrics.METRICS_PORT}",
+        extra={"task_id": "metrics"},
+    )
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,107 @@
+"""
+The rq queues, and the routing of the conversion jobs between them.
+
+The conversions of the small feeds are quick, so they have their own queue
+and do not wait behind the conversions of the big feeds.
+The scheduled tasks (merge, cleanup) go in the maintenance queue.
+"""
+import os
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from rq import Queue  # type: ignore
+from redis_connection import get_redis
+
+SMALL = "small"
+LARGE = "large"
+MAINTENANCE = "maintenance"
+# the queue used before the routing, still listened to for the jobs enqueued before
+DEFAULT = "default"
+
+# feeds bigger than this (in bytes) are converted in the large queue
+LARGE_FEED_SIZE = int(os.environ.get("LARGE_FEED_SIZE", 20 * 1024 ** 2))
+# timeout (in seconds) of the HEAD request done to know the size of a new feed
+FEED_SIZE_PROBE_TIMEOUT = float(os.environ.get("FEED_SIZE_PROBE_TIMEOUT", 5))
+# the size of a feed is remembered for this delay (in seconds)
+FEED_SIZE_TTL = int(os.environ.get("FEED_SIZE_TTL", 30 * 24 * 3600))
+# number of HEAD requests done at the same time
+FEED_SIZE_PROBE_CONCURRENCY = int(os.environ.get("FEED_SIZE_PROBE_CONCURRENCY", 8))
+# queues listened to by a worker, by decreasing priority
+WORKER_QUEUES = os.environ.get(
+    "WORKER_QUEUES", f"{SMALL},{LARGE},{MAINTENANCE},{DEFAULT}"
+)
+
+
+def _size_key(url):
+    return f"feed_size:{hashlib.sha1(url.encode()).hexdigest()}"
+
+
+def record_feed_size(url, size):
+    """
+    Remembers the size of the feed, for the routing of its next conversions
+    """
+    get_redis().set(_size_key(url), size, ex=FEED_SIZE_TTL)
+
+
+def _probe_feed_size(url):
+    # the probe is done while answering an api call, so it is done only once,
+    # with a short timeout, instead of using the retrying http session
+    try:
+        response = requests.head(
+            url, allow_redirects=True, timeout=FEED_SIZE_PROBE_TIMEOUT
+        )
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+    except (requests.RequestException, KeyError, ValueError) as e:
+        logging.info(f"impossible to know the size of {url}: {e}")
+        return None
+
+
+def feed_sizes(urls, connection=None, probe=True):
+    """
+    Returns the size of the feeds (by url), the last one seen by a worker
+    or the one announced by the producer (only if `probe` is True), None if it is unknown
+    """
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    known_sizes = (connection or get_redis()).mget([_size_key(url) for url in urls])
+    sizes = {url: int(size) for url, size in zip(urls, known_sizes) if size is not None}
+
+    unknown = [url for url in urls if url not in sizes]
+    if not probe:
+        sizes.update(dict.fromkeys(unknown))
+    elif unknown:
+        with ThreadPoolExecutor(max_workers=FEED_SIZE_PROBE_CONCURRENCY) as executor:
+            sizes.update(zip(unknown, executor.map(_probe_feed_size, unknown)))
+    return sizes
+
+
+def conversion_queue_names(urls, connection=None, probe=True):
+    """
+    Returns the name of the queue (by url) in which the conversion of the feeds should be done.
+
+    The feeds without a known size can be big (they are often generated on the fly),
+    they go in the large queue.
+    The size of the feeds never seen by a worker is asked to the producers only if `probe` is True.
+    """
+    return {
+        url: SMALL if size is not None and size < LARGE_FEED_SIZE else LARGE
+        for url, size in feed_sizes(urls, connection, probe).items()
+    }
+
+
+def get_queue(name, connection=None):
+    return Queue(name, connection=connection or get_redis())
+
+
+def worker_queues(connection=None):
+    """
+    Returns the queues listened to by a worker, in order of priority
+    """
+    return [
+        get_queue(name.strip(), connection)
+        for name in WORKER_QUEUES.split(",")
+        if name.strip()
+    ]
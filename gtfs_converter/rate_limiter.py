@@ -0,0 +1,73 @@
+"""
+Rate limiter shared by all the processes using the same redis
+(the api, the workers and the scheduled tasks).
+
+Each class of endpoint has its own token bucket, stored in redis.
+"""
+import os
+import time
+import logging
+import redis
+from redis_connection import get_redis
+
+# number of requests per second allowed for each class of endpoint
+RATE_LIMITS = {
+    "read": float(os.environ.get("DATAGOUV_RATE_LIMIT_READ", 10)),
+    # uploads and metadata updates
+    "upload": float(os.environ.get("DATAGOUV_RATE_LIMIT_UPLOAD", 2)),
+    "delete": float(os.environ.get("DATAGOUV_RATE_LIMIT_DELETE", 5)),
+}
+
+# Atomically refills the bucket with the tokens earned since the last call, and takes one.
+# Returns the time (in seconds) to wait before a token is available, 0 if it has been taken.
+_TAKE_TOKEN_SCRIPT = """
+-- needed to write after reading the (non deterministic) time on redis < 5
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - timestamp) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "timestamp", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+_take_token = None
+
+
+def acquire(endpoint_class):
+    """
+    Blocks until a request on this class of endpoint is allowed.
+
+    If redis is not available, the requests are not limited
+    """
+    global _take_token
+    rate = RATE_LIMITS[endpoint_class]
+    # we allow bursts of one second of requests
+    capacity = max(rate, 1)
+    try:
+        if _take_token is None:
+            _take_token = get_redis().register_script(_TAKE_TOKEN_SCRIPT)
+        while True:
+            wait = float(
+                _take_token(
+                    keys=[f"rate_limiter:{endpoint_class}"], args=[rate, capacity]
+                )
+            )
+            if wait == 0:
+                return
+            time.sleep(wait)
+    except redis.RedisError as e:
+        logging.warning(f"impossible to use the rate limiter, not limiting: {e}")
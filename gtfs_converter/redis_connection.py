@@ -0,0 +1,14 @@
+import os
+from redis import Redis
+
+_redis = None
+
+
+def get_redis():
+    """
+    Returns the redis connection of the process
+    """
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(os.environ.get("REDIS_URL") or "redis://")
+    return _redis
@@ -3,6 +3,7 @@ import rq
 from redis import Redis
 import os
 import sys
+import queues
 
 import init_log
 import logging
@@ -10,11 +11,11 @@ import logging
 
 def _run_scheduler():
     with rq.Connection(Redis.from_url(os.environ.get("REDIS_URL") or "redis://")):
-        q = rq.Queue()
+        q = rq.Queue(queues.MAINTENANCE)
         scheduler = Scheduler(queue=q)
 
         scheduler.cron(
-            cron_string="0 7 * * 2",  # every tuesday at 7:00,
+            cron_string="0 7 * * *",  # every day at 7:00,
             func="merge_all_geojson.merge_geojson",
             timeout="20m",
         )
@@ -34,7 +35,7 @@ def _run_task(task):
     logging.info(f"scheduling task {task} in 1s", extra={"task_id": "scheduler"})
 
     with rq.Connection(Redis.from_url(os.environ.get("REDIS_URL") or "redis://")):
-        q = rq.Queue()
+        q = rq.Queue(queues.MAINTENANCE)
         scheduler = Scheduler(queue=q)
 
         scheduler.enqueue_in(
@@ -1,13 +1,46 @@
 import subprocess
-import urllib
 import logging
 import re
 import tempfile
+import hashlib
+import shutil
+import requests
 
 import select
 import fcntl
 import os
 import errno
+import functools
+import time
+import signal
+import resource
+import threading
+
+import http_session
+import job_metrics
+import metrics
+from pylogctx import context as log_context  # type: ignore
+from disk_cache import DiskCache, make_key
+
+GTFS_CACHE_DIR = os.environ.get(
+    "GTFS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gtfs_cache")
+)
+GTFS_CACHE_MAX_SIZE = int(os.environ.get("GTFS_CACHE_MAX_SIZE", 10 * 1024 ** 3))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_gtfs_cache = None
+
+# the process groups of the commands started by this process and still running
+_running_groups = set()
+_running_groups_lock = threading.Lock()
+
+
+def _get_gtfs_cache():
+    global _gtfs_cache
+    if _gtfs_cache is None:
+        _gtfs_cache = DiskCache(GTFS_CACHE_DIR, GTFS_CACHE_MAX_SIZE)
+    return _gtfs_cache
+
 
 # from: http://stackoverflow.com/questions/7729336/how-can-i-print-and-display-subprocess-stdout-and-stderr-output-without-distorti/7730201#7730201
 def make_async(fd):
@@ -26,16 +59,189 @@ def read_async(fd):
             return ""
 
 
-def run_command(command):
+def _has_exited(pid):
+    # WNOWAIT keeps the process as a zombie, so we can still read its /proc entry
+    return os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+
+def _read_proc_io(pid):
+    """
+    Returns the i/o counters of the process, as a dict (see `man proc`)
+    """
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            return {
+                k: int(v) for k, v in (line.split(":") for line in f if ":" in line)
+            }
+    except (OSError, ValueError):
+        return {}
+
+
+def _read_peak_rss(pid):
+    """
+    Returns the peak resident set size of the process (in bytes), None if it is unknown
+    (the memory of a zombie process has already been released)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _record_usage(command, return_code, wall_time, rusage, proc_io, peak_rss):
+    usage = {
+        "command": os.path.basename(command[0]),
+        "task_id": log_context.as_dict().get("task_id"),
+        "return_code": return_code,
+        "wall_time": wall_time,
+        "user_time": rusage.ru_utime,
+        "system_time": rusage.ru_stime,
+        # ru_maxrss is in KB on linux, and it keeps the peak of the parent
+        # (before the exec), it is only used if the peak of the command is unknown
+        "max_rss": peak_rss or rusage.ru_maxrss * 1024,
+        # the rusage block counters are in 512 bytes blocks
+        "read_bytes": proc_io.get("read_bytes", rusage.ru_inblock * 512),
+        "write_bytes": proc_io.get("write_bytes", rusage.ru_oublock * 512),
+    }
+    logging.info(f"resources used by {usage['command']}: {usage}")
+    job_metrics.append("commands", usage)
+    metrics.COMMAND_EXITS.labels(usage["command"], str(return_code)).inc()
+    return usage
+
+
+class ResourceLimits:
+    """
+    Limits of the resources a command can use (None means no limit)
+
+    `memory` is in bytes, `cpu_time` and `wall_time` in seconds
+    """
+
+    def __init__(self, memory=None, cpu_time=None, wall_time=None):
+        self.memory = memory
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+
+    @classmethod
+    def from_env(cls, prefix, default_wall_time=None):
+        """
+        Reads the limits from the `{prefix}_MAX_MEMORY_MB`, `{prefix}_MAX_CPU_SECONDS`
+        and `{prefix}_TIMEOUT` environment variables
+        """
+        memory = os.environ.get(f"{prefix}_MAX_MEMORY_MB")
+        cpu_time = os.environ.get(f"{prefix}_MAX_CPU_SECONDS")
+        wall_time = os.environ.get(f"{prefix}_TIMEOUT", default_wall_time)
+        return cls(
+            memory=int(memory) * 1024 * 1024 if memory else None,
+            cpu_time=int(cpu_time) if cpu_time else None,
+            wall_time=float(wall_time) if wall_time else None,
+        )
+
+    def apply(self, pid):
+        if self.memory:
+            resource.prlimit(pid, resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.cpu_time:
+            # the process receives a SIGXCPU at the soft limit, and is killed at the hard limit
+            resource.prlimit(
+                pid, resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time + 5)
+            )
+
+
+class ResourceExceededError(Exception):
+    """
+    The command has been stopped because it exceeded one of its resource limits
+    """
+
+    def __init__(self, command, resource_name):
+        super().__init__(f"{command} exceeded its {resource_name} limit")
+        self.command = command
+        self.resource_name = resource_name
+
+
+def _kill_process_group(pgid, grace_period=10):
+    """
+    Asks all the processes of the group to stop, and kills them after the grace period
+    """
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+        deadline = time.monotonic() + grace_period
+        while not _has_exited(pgid) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def kill_running_commands():
+    """
+    Kills the commands started by this process that are still running.
+
+    The commands run in their own process group, so they are not stopped with the process
+    (for example when rq stops a job after its timeout)
+    """
+    with _running_groups_lock:
+        groups = list(_running_groups)
+    for pgid in groups:
+        logging.warning(f"killing the process group {pgid}")
+        _kill_process_group(pgid, grace_period=0)
+
+
+def _exceeded_resource(limits, status, rusage, timed_out):
+    if timed_out:
+        return "wall time"
+    if not os.WIFSIGNALED(status):
+        return None
+    sig = os.WTERMSIG(status)
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    if limits.cpu_time and (sig == signal.SIGXCPU or cpu_time >= limits.cpu_time):
+        return "cpu time"
+    # an allocation failure usually makes the process abort (or crash)
+    if limits.memory and sig in (signal.SIGABRT, signal.SIGSEGV, signal.SIGBUS):
+        return "memory"
+    return None
+
+
+def run_command(command, limits=None):
+    """
+    Runs the command, logging its output, and returns its exit code.
+
+    The command is run in its own process group, with the given `ResourceLimits`.
+    A `ResourceExceededError` is raised if it exceeded one of them.
 
+    The resources used by the command (time, cpu, memory and i/o) are recorded in the job metrics
+    """
+    limits = limits or ResourceLimits()
+    start = time.monotonic()
     proc = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+        start_new_session=True,
     )
+    with _running_groups_lock:
+        _running_groups.add(proc.pid)
+    proc_io = {}
+    peak_rss = None
+    timed_out = False
     try:
+        # the limits are set after the start (and not in a preexec_fn)
+        # because it's not safe to use preexec_fn when there are several threads
+        limits.apply(proc.pid)
         make_async(proc.stderr)
         make_async(proc.stdout)
         while True:
-            select.select([proc.stdout, proc.stderr], [], [])
+            # we wake up regularly to sample the i/o counters and the memory of the process
+            select.select([proc.stdout, proc.stderr], [], [], 1)
 
             output = read_async(proc.stdout)
             if output:
@@ -44,12 +250,37 @@ def run_command(command):
             if output_err:
                 logging.error(output_err.strip())
 
-            if proc.poll() is not None:
+            exited = _has_exited(proc.pid)
+            proc_io = _read_proc_io(proc.pid) or proc_io
+            peak_rss = _read_peak_rss(proc.pid) or peak_rss
+            if exited:
                 break
+
+            if limits.wall_time and time.monotonic() - start > limits.wall_time:
+                logging.error(f"{command[0]} is too long, stopping it")
+                timed_out = True
+                _kill_process_group(proc.pid)
+                break
+    except:
+        _kill_process_group(proc.pid, grace_period=0)
+        raise
     finally:
         proc.stdout.close()
         proc.stderr.close()
 
+    # we reap the process ourself to get its resource usage
+    _, status, rusage = os.wait4(proc.pid, 0)
+    with _running_groups_lock:
+        _running_groups.discard(proc.pid)
+    proc.returncode = _exit_code(status)
+    _record_usage(
+        command, proc.returncode, time.monotonic() - start, rusage, proc_io, peak_rss
+    )
+
+    exceeded_resource = _exceeded_resource(limits, status, rusage, timed_out)
+    if exceeded_resource:
+        raise ResourceExceededError(os.path.basename(command[0]), exceeded_resource)
+
     return proc.returncode
 
 
@@ -57,23 +288,185 @@ def run_command_get_stdout(command):
     return subprocess.check_output(command)
 
 
-def download_gtfs(url):
+class _ProcessMonitor(threading.Thread):
     """
-    Downloads the requested GTFS and saves it as local file.
-    Returns the path to that file
+    Samples the i/o counters and the memory of a process every second,
+    and stops its process group when it exceeds its wall time
     """
-    logging.debug(f"Start downloading {url}")
-    local_filename, headers = urllib.request.urlretrieve(url)
 
+    def __init__(self, command, pid, wall_time):
+        super().__init__(daemon=True)
+        self.command = command
+        self.pid = pid
+        self.wall_time = wall_time
+        self.start_time = time.monotonic()
+        self.proc_io = {}
+        self.peak_rss = None
+        self.timed_out = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(1):
+            try:
+                exited = _has_exited(self.pid)
+            except ChildProcessError:
+                # already reaped
+                return
+            self.proc_io = _read_proc_io(self.pid) or self.proc_io
+            self.peak_rss = _read_peak_rss(self.pid) or self.peak_rss
+            if exited:
+                return
+            if self.wall_time and time.monotonic() - self.start_time > self.wall_time:
+                logging.error(f"{self.command[0]} is too long, stopping it")
+                self.timed_out = True
+                _kill_process_group(self.pid)
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def stream_command_stdout(command, limits=None, chunk_size=64 * 1024):
+    """
+    Runs the command and yields its output by chunks, as soon as they are available.
+
+    Like `run_command`, the command is run in its own process group with the given `ResourceLimits`,
+    and the resources it used are recorded.
+    A `ResourceExceededError` is raised at the end if it exceeded one of its limits,
+    a CalledProcessError if it failed.
+    The command is killed if the iteration is stopped before its end.
+    """
+    limits = limits or ResourceLimits()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, start_new_session=True)
+    with _running_groups_lock:
+        _running_groups.add(proc.pid)
+    monitor = _ProcessMonitor(command, proc.pid, limits.wall_time)
+    complete = False
+    try:
+        limits.apply(proc.pid)
+        monitor.start()
+        for chunk in iter(lambda: proc.stdout.read1(chunk_size), b""):
+            yield chunk
+        complete = True
+    finally:
+        if not complete:
+            _kill_process_group(proc.pid, grace_period=0)
+        proc.stdout.close()
+        # the monitor keeps enforcing the wall time until the command exits
+        _, status, rusage = os.wait4(proc.pid, 0)
+        monitor.stop()
+        with _running_groups_lock:
+            _running_groups.discard(proc.pid)
+        proc.returncode = _exit_code(status)
+        _record_usage(
+            command,
+            proc.returncode,
+            time.monotonic() - monitor.start_time,
+            rusage,
+            monitor.proc_io,
+            monitor.peak_rss,
+        )
+
+    exceeded_resource = _exceeded_resource(limits, status, rusage, monitor.timed_out)
+    if exceeded_resource:
+        raise ResourceExceededError(os.path.basename(command[0]), exceeded_resource)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+@functools.lru_cache()
+def converter_version(converter):
+    """
+    Returns a string identifying the version of a converter binary.
+
+    We use the hash of the binary: the converters are built from a branch,
+    so their `--version` does not change with their code
+    """
+    sha256 = hashlib.sha256()
+    with open(shutil.which(converter) or converter, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _get_file_name(url, headers):
     # we try to get the filename from the Content-Disposition header, else we get it from the url
     fname_in_header = re.findall(
         'filename="?([^"]+)"?', headers.get("Content-Disposition", "")
     )
     if fname_in_header:
-        fname = fname_in_header[0]
-    else:
-        fname = url.split("/")[-1]
+        return fname_in_header[0]
+    return url.split("/")[-1]
+
+
+def download_with_cache(url, cache, max_age=0):
+    """
+    Downloads the url in the cache, indexed by url and by content hash.
+    Returns the path to the cached file, its name and its sha256
+
+    If the url has already been downloaded, we only ask the server if it has changed
+    (with the ETag and Last-Modified headers) and reuse the cached file if it has not.
+    If it has been downloaded less than `max_age` seconds ago, the server is not even asked.
+    """
+    url_key = make_key("url", url)
+
+    cached = cache.get_meta(url_key)
+    cached_file = cache.get(make_key("content", cached["sha256"])) if cached else None
+
+    if cached_file and time.time() - cached.get("fetched_at", 0) < max_age:
+        return cached_file, cached["fname"], cached["sha256"]
+
+    headers = {}
+    if cached_file:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    logging.debug(f"Start downloading {url}")
+    with http_session.get_session().get(url, headers=headers, stream=True) as r:
+        if r.status_code == requests.codes.not_modified and cached_file:
+            logging.debug(f"{url} has not changed, using cached file {cached_file}")
+            cache.set_meta(url_key, {**cached, "fetched_at": time.time()})
+            return cached_file, cached["fname"], cached["sha256"]
+        r.raise_for_status()
+
+        sha256 = hashlib.sha256()
+        with cache.tmp_file() as tmp:
+            try:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+                    metrics.DOWNLOADED_BYTES.inc(len(chunk))
+            except:
+                os.remove(tmp.name)
+                raise
+        checksum = sha256.hexdigest()
+
+        fname = _get_file_name(url, r.headers)
+        local_filename = cache.put(make_key("content", checksum), tmp.name)
+        cache.set_meta(
+            url_key,
+            {
+                "sha256": checksum,
+                "fname": fname,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            },
+        )
 
     logging.debug(f"Downloading done at {local_filename} {fname}")
 
-    return local_filename, fname
+    return local_filename, fname, checksum
+
+
+def download_gtfs(url):
+    """
+    Downloads the requested GTFS and saves it as local file.
+    Returns the path to that file, its name and its sha256
+
+    The downloaded files are kept in a cache shared by all the jobs of the node.
+    """
+    return download_with_cache(url, _get_gtfs_cache())
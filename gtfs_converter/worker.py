@@ -1,14 +1,28 @@
 import rq  # type: ignore
 from redis import Redis
 import os
+import queues
+import metrics
 
 import init_log
 import logging
 
 
+class Worker(rq.Worker):
+    def execute_job(self, job, queue):
+        super().execute_job(job, queue)
+        # the work horse is dead, its metrics files can be merged
+        try:
+            metrics.compact_host_files()
+        except OSError:
+            logging.exception("impossible to merge the metrics files")
+
+
 if __name__ == "__main__":
     init_log.config_worker_log()
+    # the metrics of the previous work horses of this container are not needed anymore
+    metrics.clear_host_files()
     # Tell rq what Redis connection to use
     with rq.Connection(Redis.from_url(os.environ.get("REDIS_URL") or "redis://")):
-        q = rq.Queue()
-        rq.Worker(q).work()
+        # the queues are listened to by order of priority
+        Worker(queues.worker_queues()).work()
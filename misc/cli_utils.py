@@ -1,10 +1,19 @@
 import tempfile
 import requests
 import os
+import sys
+import json
 import logging
 import fire
 import collections
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gtfs_converter")
+)
+import catalog
+import datagouv
+import community_resources_index
+
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s -- %(levelname)s -- %(message)s"
@@ -20,35 +29,21 @@ def _find_community_resources(dataset_id):
     returns all netex created as $TRANSPORT_ORGANIZATION_ID as community resource
     """
     logging.debug("Searching community ressource in dataset %s", dataset_id)
-    url = f"{DATAGOUV_API}/datasets/community_resources/"
-    params = {"dataset": dataset_id, "organization": TRANSPORT_ORGANIZATION_ID, "page_size": 50}
-    ret = requests.get(url, params=params)
-    ret.raise_for_status()
-
-    data = ret.json()["data"]
-
-    if data is not None:
-        return data
-    raise Exception(
-        f"Searched community ressources of dataset {dataset_id}, could not understand response"
-    )
+    return datagouv.get_transport_community_resources(dataset_id)
 
 
 def _delete_community_resources(dataset_id, resources):
     """
-    delete the community resources
+    delete the community resources, and remove them from the community resources index
     """
     logging.debug("deleting %s", resources)
-    headers = {"X-API-KEY": DATAGOUV_API_KEY}
 
     for r in resources:
-        url = f"{DATAGOUV_API}/datasets/community_resources/{r['id']}"
-
         logging.info(
             "deleting a community resource %s on dataset %s", r["title"], dataset_id
         )
-        ret = requests.delete(url, params={"dataset": dataset_id}, headers=headers)
-        ret.raise_for_status()
+        datagouv.delete_community_resources(dataset_id, r["id"])
+        community_resources_index.remove(dataset_id, r["id"])
 
 
 def _delete_dataset_netex(dataset_id):
@@ -77,18 +72,11 @@ def delete_dataset_without_original_url():
     logging.warning(
         "*** deleting all netex files created by transport.data.gouv.fr ***"
     )
-    r = requests.get("https://transport.data.gouv.fr/api/datasets")
-    r.raise_for_status()
-    datasets = r.json()
 
     print_resource = lambda r: f"\n\t*[url = {r['url']} | extras = {r.get('extras')}]"
     print_resources = lambda rs: [print_resource(r) for r in rs]
 
-    for d in datasets:
-        dataset_name = d["title"]
-        if d["type"] != "public-transit":
-            continue
-
+    for d in catalog.get_catalog().public_transit_datasets.values():
         dataset_id = d["id"]
 
         community_resources = _find_community_resources(dataset_id)
@@ -111,14 +99,8 @@ def delete_all_netex():
     logging.warning(
         "*** deleting all netex files created by transport.data.gouv.fr ***"
     )
-    r = requests.get("https://transport.data.gouv.fr/api/datasets")
-    r.raise_for_status()
-    datasets = r.json()
 
-    for d in datasets:
-        dataset_name = d["title"]
-        if d["type"] != "public-transit":
-            continue
+    for d in catalog.get_catalog().public_transit_datasets.values():
         _delete_dataset_netex(d["datagouv_id"])
 
 
@@ -131,15 +113,7 @@ def _get_duplicated_resources(community_resources):
 
 
 def get_netex_duplicates():
-    r = requests.get("https://transport.data.gouv.fr/api/datasets")
-    r.raise_for_status()
-    datasets = r.json()
-
-    for d in datasets:
-        dataset_name = d["title"]
-        if d["type"] != "public-transit":
-            continue
-
+    for d in catalog.get_catalog().public_transit_datasets.values():
         rs = _find_community_resources(d["datagouv_id"])
         if not rs:
             continue
@@ -155,15 +129,7 @@ def get_netex_duplicates():
 
 def delete_old_netex_duplicates():
     logging.warning("DELETING OLD NETEX DUPLICATES!")
-    r = requests.get("https://transport.data.gouv.fr/api/datasets")
-    r.raise_for_status()
-    datasets = r.json()
-
-    for d in datasets:
-        dataset_name = d["title"]
-        if d["type"] != "public-transit":
-            continue
-
+    for d in catalog.get_catalog().public_transit_datasets.values():
         rs = _find_community_resources(d["datagouv_id"])
         if not rs:
             continue
@@ -185,5 +151,15 @@ def delete_old_netex_duplicates():
                     _delete_community_resources(d["id"], [r])
 
 
+def get_cleanup_plan():
+    """
+    Print (as json, on stdout) the community resources that would be deleted by the cleanup
+    """
+    import cleanup
+
+    plan = cleanup.cleanup_old_resources(dry_run=True)
+    print(json.dumps(plan, ensure_ascii=False, indent=2))
+
+
 if __name__ == "__main__":
     fire.Fire()
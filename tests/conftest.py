@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the modules of the converter import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "gtfs_converter"))
+
+os.environ.setdefault("DATAGOUV_API", "http://datagouv.test/api/1")
+os.environ.setdefault("DATAGOUV_API_KEY", "test")
+os.environ.setdefault("TRANSPORT_ORGANIZATION_ID", "test")
+os.environ.setdefault("AGGREGATED_DATASET_ID", "test")
@@ -0,0 +1,89 @@
+import json
+import zipfile
+import pytest
+
+ogr = pytest.importorskip("osgeo.ogr")
+pytest.importorskip("ijson")
+pytest.importorskip("jsonseq")
+merge_all_geojson = pytest.importorskip("merge_all_geojson")
+from disk_cache import DiskCache  # noqa: E402
+
+RESOURCE = {"dataset_id": "dataset", "resource_url": "http://producer.test/a.geojson"}
+
+
+def _feature(lon, properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lon, 48.85]},
+        "properties": properties,
+    }
+
+
+def _build_block(tmp_path, content):
+    geojson = tmp_path / "resource.geojson"
+    geojson.write_text(content)
+    fetcher = object.__new__(merge_all_geojson._ResourceFetcher)
+    fetcher._cache = DiskCache(str(tmp_path / "cache"), 10 ** 9)
+    return fetcher._build_block("key", RESOURCE, str(geojson))
+
+
+def test_block_written_in_all_formats(tmp_path, monkeypatch):
+    block = _build_block(
+        tmp_path,
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    _feature(2.35, {"name": "a", "code": 1, "stop": 3}),
+                    _feature(2.36, {"name": "b", "code": 2.5, "stop": "A"}),
+                    _feature(2.37, {"name": "c", "route": {"id": 1}}),
+                ],
+            }
+        ),
+    )
+    monkeypatch.setattr(
+        merge_all_geojson, "_get_all_transport_geojson_resources", lambda: [RESOURCE]
+    )
+    monkeypatch.setattr(
+        merge_all_geojson, "_fetch_all", lambda resources, _: [(RESOURCE, block)]
+    )
+
+    geojson_zip, geojson_line_zip, geopackage = merge_all_geojson._create_merged_files(
+        str(tmp_path)
+    )
+
+    with zipfile.ZipFile(geojson_line_zip) as z:
+        lines = z.read("public-transit.geojsonl").splitlines()
+    assert len(lines) == 3
+    assert all(line.startswith(b"\x1e") for line in lines)
+    assert json.loads(lines[0][1:])["properties"]["name"] == "a"
+
+    with zipfile.ZipFile(geojson_zip) as z:
+        collection = json.loads(z.read("public-transit.geojson"))
+    assert [f["properties"]["name"] for f in collection["features"]] == ["a", "b", "c"]
+    assert collection["features"][0]["dataset_id"] == "dataset"
+
+    datasource = ogr.Open(geopackage)
+    layer = datasource.GetLayer("public-transit")
+    definition = layer.GetLayerDefn()
+    types = {
+        definition.GetFieldDefn(i).GetName(): definition.GetFieldDefn(i).GetType()
+        for i in range(definition.GetFieldCount())
+    }
+    assert types["code"] == ogr.OFTReal
+    assert types["stop"] == ogr.OFTString
+    assert types["route"] == ogr.OFTString
+    features = list(layer)
+    assert [f.GetField("name") for f in features] == ["a", "b", "c"]
+    assert [f.GetField("code") for f in features] == [1.0, 2.5, None]
+    assert [f.GetField("stop") for f in features] == ["3", "A", None]
+    assert features[0].GetField("dataset_id") == "dataset"
+
+
+def test_invalid_geojson_is_not_cached(tmp_path):
+    block = _build_block(
+        tmp_path,
+        '{"type": "FeatureCollection", "features": [%s, {"type": '
+        % json.dumps(_feature(2.35, {"name": "a"})),
+    )
+    assert block is None